@@ -0,0 +1,156 @@
+import os
+import copy
+import json
+import math
+import time
+
+import numpy as np
+import torch
+
+## Startup tuning of DataLoader workers, intra-op threads and prefetch depth
+# The data pipeline is timed alone for several worker counts (batches/sec) and the training step alone for several
+# intra-op thread counts (steps/sec). The chosen pair is the one with the highest estimated throughput that fits in
+# the available cores (workers + threads <= cores): min(data, model) with workers, or both in series with
+# num_workers=0. Among settings within `tolerance` of the best, ones where the data keeps ahead of the model are
+# preferred, then the one using the fewest cores. On GPUs, the prefetch depth is sized to absorb the slowest batch.
+
+def available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+def powers_of_two(limit, start=1):
+    """ start, then 1, 2, 4, ... up to limit, always including limit
+    """
+    values = [start] + [2 ** i for i in range(int(math.log2(max(1, limit))) + 1)] + [limit]
+    return sorted(set(v for v in values if start <= v <= limit))
+
+def compute_step(config, x, device):
+    """ Forward + backward of a training batch without touching the optimizer or the stats
+    """
+    line_imgs = x['line_imgs'].to(device)
+    if line_imgs.dtype != torch.uint8:
+        line_imgs = line_imgs.float()
+    if config["batch_augmenter"]:
+        line_imgs = config["batch_augmenter"](line_imgs)
+    online = x['online'].to(device).view(1, -1, 1)
+    trainer = config["trainer"]
+    pred_logits = trainer.to_loss_device(trainer.forward(line_imgs, online)[0])
+    trainer.ctc_loss(pred_logits, x['labels'], x['label_lengths']).backward()
+    config["model"].zero_grad()
+
+def data_rate(loader, batches):
+    """ Batches/sec of a DataLoader once its workers are running, and the gaps between batches in seconds
+    """
+    iterator = iter(loader)
+    gaps = []
+    try:
+        for _ in range(max(1, loader.num_workers)): # each worker's first batch includes its start-up
+            next(iterator)
+        for _ in range(batches):
+            start = time.perf_counter()
+            next(iterator)
+            gaps.append(time.perf_counter() - start)
+    except StopIteration:
+        pass
+    finally:
+        del iterator # shuts the workers down
+    if not gaps:
+        return None, []
+    return len(gaps) / sum(gaps), gaps
+
+def model_rate(config, batch, device, batches):
+    """ Training steps/sec on a fixed batch with the current number of intra-op threads
+    """
+    sync = torch.cuda.synchronize if torch.device(device).type == "cuda" else lambda: None
+    compute_step(config, batch, device) # warm up
+    sync()
+    start = time.perf_counter()
+    for _ in range(batches):
+        compute_step(config, batch, device)
+    sync()
+    return batches / (time.perf_counter() - start)
+
+def choose(data_rates, model_rates, cores, tolerance=.05):
+    """
+    Args:
+        data_rates (dict): num_workers -> batches/sec
+        model_rates (dict): torch threads -> steps/sec
+        cores (int): available cores
+
+    Returns:
+        tuple: num_workers, torch threads, estimated steps/sec
+    """
+    candidates = []
+    for workers, data in data_rates.items():
+        for threads, model in model_rates.items():
+            if workers + threads > cores:
+                continue
+            throughput = 1 / (1 / data + 1 / model) if workers == 0 else min(data, model)
+            candidates.append((throughput, data >= model or workers == 0, workers, threads))
+    if not candidates: # fewer cores than the smallest setting
+        workers, threads = min(data_rates), min(model_rates)
+        return workers, threads, min(data_rates[workers], model_rates[threads])
+    best = max(c[0] for c in candidates)
+    close = [c for c in candidates if c[0] >= (1 - tolerance) * best]
+    throughput, fed, workers, threads = min(close, key=lambda c: (not c[1], c[2] + c[3], c[2]))
+    return workers, threads, throughput
+
+def tune(config, make_loader, device, batches=10, max_workers=8, max_prefetch_depth=4):
+    """ Measure and set config["num_workers"], config["torch_threads"] (also applied) and, on GPUs,
+        config["prefetch_depth"]; the measurements are saved to results_dir/autotune.json
+
+        The model is left as it was: its state (e.g. BatchNorm running statistics updated by the
+        training-mode passes) is restored after timing.
+
+    Args:
+        make_loader (function): num_workers -> training DataLoader
+        batches (int): batches timed per setting
+        max_workers (int): largest number of workers tried
+
+    Returns:
+        dict: chosen settings and measurements
+    """
+    logger = config["logger"]
+    cores = available_cores()
+    logger.info(f"Autotuning data loading and threads on {cores} cores...")
+
+    data_rates, gaps = {}, {}
+    for workers in [0] + powers_of_two(max(1, min(cores - 1, max_workers))):
+        rate, gaps[workers] = data_rate(make_loader(workers), batches)
+        if rate is None:
+            break
+        data_rates[workers] = rate
+        logger.info(f"  {workers} workers: {rate:.2f} batches/s")
+    if not data_rates:
+        logger.warning("Autotune: not enough training batches to time; keeping num_workers/torch_threads")
+        return None
+
+    batch = next(iter(make_loader(0)))
+    original_threads = torch.get_num_threads()
+    model_state = copy.deepcopy(config["model"].state_dict())
+    model_rates = {}
+    try:
+        for threads in powers_of_two(cores):
+            torch.set_num_threads(threads)
+            model_rates[threads] = model_rate(config, batch, device, batches)
+            logger.info(f"  {threads} threads: {model_rates[threads]:.2f} steps/s")
+    finally:
+        config["model"].load_state_dict(model_state)
+        torch.set_num_threads(original_threads)
+
+    workers, threads, throughput = choose(data_rates, model_rates, cores)
+    config["num_workers"], config["torch_threads"] = workers, threads
+    torch.set_num_threads(threads)
+    if torch.device(device).type == "cuda" and workers and gaps[workers]:
+        # Deep enough that the slowest batch arrives before the staged ones are used up
+        step_time = 1 / model_rates[threads]
+        config["prefetch_depth"] = int(np.clip(math.ceil(max(gaps[workers]) / step_time), 1, max_prefetch_depth))
+
+    result = {"cores": cores, "num_workers": workers, "torch_threads": threads, "prefetch_depth": config["prefetch_depth"],
+              "estimated_steps_per_sec": throughput,
+              "data_batches_per_sec": {str(k): v for k, v in data_rates.items()},
+              "model_steps_per_sec": {str(k): v for k, v in model_rates.items()}}
+    with open(os.path.join(config["results_dir"], "autotune.json"), "w") as f:
+        json.dump(result, f, indent=2)
+    logger.info(f"Autotune: {workers} workers, {threads} threads, prefetch depth {config['prefetch_depth']} "
+                f"(~{throughput:.2f} steps/s)")
+    return result
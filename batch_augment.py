@@ -0,0 +1,127 @@
+import torch
+import torch.nn.functional as F
+
+## Batched augmentation
+# Tensor equivalents of grid_distortion.warp_image, _occlude and gaussian_noise that work on a whole
+# padded batch (batch, channel, height, width) at once, on the CPU (using intra-op threads) or the GPU.
+# Images are expected in the normalized [-1, 1] range produced by collate_basic/collate_repetition; uint8 batches
+# (uint8_pipeline) are normalized first, so the output is always float.
+
+WHITE = 255 / 128.0 - 1 # white pixel after normalization
+
+def to_pixels(line_imgs):
+    return (line_imgs + 1) * 128.0
+
+def from_pixels(line_imgs):
+    return line_imgs / 128.0 - 1
+
+class BatchAugmenter:
+    def __init__(self, warp=True, occlusion_freq=None, occlusion_size=1, occlusion_level=1, noise_level=None, seed=None,
+                 w_mesh_interval=25, w_mesh_std=3.0, h_mesh_interval=25, h_mesh_std=3.0):
+        """ Random mesh warp, occlusion and noise for a whole batch, with new random parameters for every image
+
+        Args:
+            warp (bool): random elastic mesh distortion (see grid_distortion.warp_image)
+            occlusion_freq (float): each image occludes a random fraction of pixels between 0 and this; None for no occlusion
+            occlusion_size (int): occluded pixels come in occlusion_size x occlusion_size blocks
+            occlusion_level (float): 1 - occluded pixels become white; otherwise they are multiplied by a random amount
+            noise_level (float): gaussian noise; .1 - light haze, 1 heavy; None for no noise
+            seed (int): seed for the random generator
+            w_mesh_interval, w_mesh_std, h_mesh_interval, h_mesh_std: mesh spacing / displacement std in pixels
+        """
+        self.warp = warp
+        self.occlusion_freq = occlusion_freq
+        self.occlusion_size = max(1, int(occlusion_size or 1))
+        self.occlusion_level = occlusion_level
+        self.noise_level = noise_level
+        self.seed = seed
+        self.w_mesh_interval = w_mesh_interval
+        self.w_mesh_std = w_mesh_std
+        self.h_mesh_interval = h_mesh_interval
+        self.h_mesh_std = h_mesh_std
+        self.generators = {} # one generator per device
+
+    def generator(self, device):
+        device = torch.device(device)
+        if device not in self.generators:
+            generator = torch.Generator(device=device)
+            if self.seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(self.seed)
+            self.generators[device] = generator
+        return self.generators[device]
+
+    def _rand(self, *size, like):
+        return torch.rand(*size, generator=self.generator(like.device), device=like.device, dtype=like.dtype)
+
+    def _randn(self, *size, like):
+        return torch.randn(*size, generator=self.generator(like.device), device=like.device, dtype=like.dtype)
+
+    def __call__(self, line_imgs):
+        """
+        Args:
+            line_imgs (Tensor): batch, channel, height, width; normalized float or uint8 pixels
+
+        Returns:
+            Tensor: augmented copy of line_imgs, normalized float
+        """
+        if line_imgs.dtype == torch.uint8:
+            line_imgs = from_pixels(line_imgs.float())
+        if self.warp:
+            line_imgs = self.warp_batch(line_imgs)
+        if self.occlusion_freq:
+            line_imgs = self.occlude_batch(line_imgs)
+        if self.noise_level:
+            line_imgs = self.noise_batch(line_imgs)
+        return line_imgs
+
+    def repetitions(self, line_imgs):
+        """ Augment the output of collate_repetition: batch, repetitions, channel, height, width
+        """
+        b, r = line_imgs.shape[:2]
+        return self(line_imgs.reshape(b * r, *line_imgs.shape[2:])).view(line_imgs.shape)
+
+    def warp_batch(self, line_imgs):
+        b, c, h, w = line_imgs.shape
+        # Number of mesh cells, fit to the image size like warp_image
+        h_cells = max(1, round(h / float(self.h_mesh_interval)))
+        w_cells = max(1, round(w / float(self.w_mesh_interval)))
+
+        # Random control point displacements (in pixels), upsampled to every pixel
+        displacement = self._randn(b, 2, h_cells + 1, w_cells + 1, like=line_imgs)
+        displacement[:, 0] *= self.w_mesh_std
+        displacement[:, 1] *= self.h_mesh_std
+        displacement = F.interpolate(displacement, size=(h, w), mode="bilinear", align_corners=True)
+
+        # Sampling grid in [-1, 1] coordinates (x, y)
+        ys = torch.linspace(-1, 1, h, device=line_imgs.device, dtype=line_imgs.dtype)
+        xs = torch.linspace(-1, 1, w, device=line_imgs.device, dtype=line_imgs.dtype)
+        grid = torch.stack(torch.meshgrid(xs, ys, indexing="xy"), dim=-1).unsqueeze(0) # 1, h, w, 2
+        scale = torch.tensor([2.0 / max(1, w - 1), 2.0 / max(1, h - 1)], device=line_imgs.device, dtype=line_imgs.dtype)
+        grid = grid + displacement.permute(0, 2, 3, 1) * scale
+
+        # Sample relative to white, so pixels pulled in from outside the image are white (like borderValue=255)
+        warped = F.grid_sample(line_imgs - WHITE, grid, mode="bilinear", padding_mode="zeros", align_corners=True)
+        return warped + WHITE
+
+    def occlude_batch(self, line_imgs):
+        b, c, h, w = line_imgs.shape
+        # Each image gets its own occlusion frequency between 0 and occlusion_freq
+        freq = self._rand(b, 1, 1, 1, like=line_imgs) * self.occlusion_freq
+        size = self.occlusion_size
+        mask = self._rand(b, 1, -(-h // size), -(-w // size), like=line_imgs) < freq
+        if size > 1: # upsample the block mask
+            mask = F.interpolate(mask.to(line_imgs.dtype), scale_factor=size, mode="nearest")[:, :, :h, :w] > 0
+        if self.occlusion_level == 1:
+            return line_imgs.masked_fill(mask, WHITE)
+        else:
+            sd = self.occlusion_level / 2
+            multiplier = (self._randn(b, 1, h, w, like=line_imgs) * sd).clamp(-1, 1)
+            occluded = from_pixels(torch.clamp((multiplier + 1) * to_pixels(line_imgs), max=255))
+            return torch.where(mask, occluded, line_imgs)
+
+    def noise_batch(self, line_imgs):
+        sd = self.noise_level / 2
+        noise = (self._randn(*line_imgs.shape, like=line_imgs) * sd).clamp(-1, 1) * 255 / 2
+        return from_pixels(torch.clamp(to_pixels(line_imgs) + noise, 0, 255))
@@ -0,0 +1,157 @@
+""" Throughput of the data pipeline: each stage on its own, then whole DataLoaders over a sweep of settings
+
+Stages (single process, images/sec): decode (cv2.imread), resize, warp, occlusion, normalization, collate
+(collate_basic, and collate_repetition if --warp-iterations is set) and tensor conversion.
+Sweep (images/sec): DataLoader(HwDataset) for every combination of --workers, --batch-sizes and --augment.
+
+Runs on the images of --images (default data/sample_offline); if there are none, synthetic lines are written to a
+temporary directory first.
+
+Usage (from the repo root):
+    python -m benchmarks.data_pipeline --workers 0 2 4 8 --batch-sizes 8 32 --augment none warp warp+occlusion --output pipeline.json
+"""
+import argparse
+import glob
+import json
+import os
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+import grid_distortion
+import hw_dataset
+from benchmarks.warp import synthetic_line
+
+AUGMENTATIONS = {"none": {}, "warp": {"warp": True}, "occlusion": {"occlusion_freq": .4, "occlusion_size": 4},
+                 "warp+occlusion": {"warp": True, "occlusion_freq": .4, "occlusion_size": 4}}
+CHAR_TO_IDX = {"|": 0, "a": 1, "b": 2, " ": 3}
+
+def prepare_images(pattern, count, height, seed=0):
+    """ Paths of the images to use: those matching pattern, or synthetic lines of random widths written to a temp dir
+    """
+    paths = sorted(glob.glob(pattern))
+    if paths:
+        return paths, False
+    random_state = np.random.RandomState(seed)
+    directory = tempfile.mkdtemp()
+    for i in range(count):
+        path = os.path.join(directory, f"{i}.png")
+        cv2.imwrite(path, synthetic_line(height * 2, int(random_state.randint(height * 8, height * 40)), seed=seed + i))
+        paths.append(path)
+    return paths, True
+
+def write_manifest(paths):
+    """ HwDataset manifest for the images (absolute paths, dummy ground truth)
+    """
+    directory = tempfile.mkdtemp()
+    items = [{"image_path": os.path.abspath(path), "gt": "ab ba", "writer_id": 0, "online": False} for path in paths]
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(items, f)
+    return directory, "manifest.json"
+
+def rate(function, items, repeats):
+    """ Items per second of function(item) over all items, best of repeats
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return len(items) / best
+
+def stage_rates(paths, opts):
+    """ images/sec of each stage on its own
+    """
+    flag = 0 if opts.channels == 1 else cv2.IMREAD_COLOR
+    raw = [cv2.imread(path, flag) for path in paths]
+    resize = lambda img: cv2.resize(img, (0, 0), fx=opts.height / img.shape[0], fy=opts.height / img.shape[0], interpolation=cv2.INTER_CUBIC)
+    resized = [resize(img) for img in raw]
+    with_channel = [img[:, :, np.newaxis] if img.ndim == 2 else img for img in resized]
+
+    rates = {"decode": rate(lambda path: cv2.imread(path, flag), paths, opts.repeats),
+             "resize": rate(resize, raw, opts.repeats),
+             "warp": rate(grid_distortion.warp_image, resized, opts.repeats),
+             "occlusion": rate(lambda img: grid_distortion.occlude(img, occlusion_freq=.4, occlusion_size=4), resized, opts.repeats),
+             "normalization": rate(lambda img: img.astype(np.float32) / 128.0 - 1.0, with_channel, opts.repeats)}
+
+    for name, uint8 in [("", False), ("_uint8", True)]:
+        items = [{"line_img": img if uint8 else img.astype(np.float32) / 128.0 - 1.0, "gt_label": np.array([1, 2, 3], np.uint32),
+                  "gt": "ab ", "writer_id": 0, "path": "", "online": False} for img in with_channel]
+        batches = [items[i:i + opts.stage_batch_size] for i in range(0, len(items) - opts.stage_batch_size + 1, opts.stage_batch_size)] or [items]
+        images_per_batch = len(batches[0])
+        rates["collate" + name] = rate(hw_dataset.collate_basic, batches, opts.repeats) * images_per_batch
+        if opts.warp_iterations:
+            rates["collate_repetition" + name] = rate(lambda b: hw_dataset.collate_repetition(b, n_warp_iterations=opts.warp_iterations),
+                                                      batches, opts.repeats) * images_per_batch
+
+        # Tensor conversion of a padded batch: transpose to batch, channel, h, w and copy to contiguous (pinned on GPU machines)
+        arrays = [hw_dataset.padded_batch((len(b), opts.height, max(x["line_img"].shape[1] for x in b), opts.channels), uint8=uint8) for b in batches]
+        def to_tensor(array):
+            tensor = torch.from_numpy(array.transpose([0, 3, 1, 2])).contiguous()
+            return tensor.pin_memory() if torch.cuda.is_available() else tensor
+        rates["tensor_conversion" + name] = rate(to_tensor, arrays, opts.repeats) * images_per_batch
+    return rates
+
+def loader_rate(root, manifest, workers, batch_size, augment, opts):
+    """ images/sec of a DataLoader over the whole manifest, after a warm-up pass that starts the workers
+    """
+    dataset = hw_dataset.HwDataset([manifest], CHAR_TO_IDX, img_height=opts.height, num_of_channels=opts.channels, root=root,
+                                   warp=AUGMENTATIONS[augment].get("warp", False), occlusion_freq=AUGMENTATIONS[augment].get("occlusion_freq"),
+                                   occlusion_size=AUGMENTATIONS[augment].get("occlusion_size"), uint8=opts.uint8)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers, collate_fn=hw_dataset.Collate(),
+                        persistent_workers=workers > 0)
+    for _ in loader: # warm up
+        pass
+    best = float("inf")
+    for _ in range(opts.repeats):
+        start = time.perf_counter()
+        for _ in range(opts.epochs):
+            for _ in loader:
+                pass
+        best = min(best, time.perf_counter() - start)
+    return len(dataset) * opts.epochs / best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=str, default="data/sample_offline/*.png", help='Glob of line images; synthetic if none match')
+    parser.add_argument('--synthetic-count', type=int, default=64)
+    parser.add_argument('--height', type=int, default=60)
+    parser.add_argument('--channels', type=int, default=1, choices=[1, 3])
+    parser.add_argument('--uint8', action="store_true", help='uint8 pipeline for the DataLoader sweep (see uint8_pipeline)')
+    parser.add_argument('--workers', type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument('--batch-sizes', type=int, nargs="+", default=[8, 32])
+    parser.add_argument('--augment', type=str, nargs="+", default=["none", "warp+occlusion"], choices=list(AUGMENTATIONS))
+    parser.add_argument('--stage-batch-size', type=int, default=8, help='Batch size for the collate/tensor stages')
+    parser.add_argument('--warp-iterations', type=int, default=0, help='Also time collate_repetition with this many warps')
+    parser.add_argument('--epochs', type=int, default=2, help='Passes over the images per DataLoader measurement')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', type=str, default=None, help='Optional path for JSON results')
+    opts = parser.parse_args()
+
+    paths, synthetic = prepare_images(opts.images, opts.synthetic_count, opts.height)
+    print(f"{len(paths)} {'synthetic images' if synthetic else 'images'}")
+
+    stages = stage_rates(paths, opts)
+    for stage, images_per_sec in stages.items():
+        print(f"{stage:>28}: {images_per_sec:10.1f} img/s")
+
+    root, manifest = write_manifest(paths)
+    sweep = []
+    for augment in opts.augment:
+        for batch_size in opts.batch_sizes:
+            for workers in opts.workers:
+                images_per_sec = loader_rate(root, manifest, workers, batch_size, augment, opts)
+                sweep.append({"augment": augment, "batch_size": batch_size, "num_workers": workers, "images_per_sec": images_per_sec})
+                print(f"{augment:>15} batch {batch_size:>3}, {workers:>2} workers: {images_per_sec:8.1f} img/s")
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump({"images": len(paths), "synthetic": synthetic, "settings": vars(opts), "stages": stages, "sweep": sweep}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+""" Compare the vectorized greedy decoder against the per-sample Python loop it replaced
+
+Usage (from the repo root):
+    python -m benchmarks.decode --batch-sizes 8 32 128 --widths 200 800 --device cpu
+"""
+import argparse
+import json
+
+import numpy as np
+import torch
+
+import string_utils
+from hwr_utils import Decoder
+from benchmarks.warp import time_it
+
+def loop_decode(out, idx_to_char):
+    """ The original decode_batch_naive: numpy copy, then string_utils.naive_decode per sample
+    """
+    out = out.data.cpu().numpy()
+    return [string_utils.label2str(string_utils.naive_decode(out[j])[0], idx_to_char, False) for j in range(out.shape[0])]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-sizes', type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument('--widths', type=int, nargs="+", default=[100, 400, 800])
+    parser.add_argument('--vocab', type=int, default=80)
+    parser.add_argument('--device', type=str, default="cpu")
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--output', type=str, default=None, help='Optional path for JSON results')
+    opts = parser.parse_args()
+
+    idx_to_char = {i: chr(32 + i) for i in range(1, opts.vocab)}
+    idx_to_char[0] = "|"
+    decoder = Decoder(idx_to_char)
+    results = []
+    for batch_size in opts.batch_sizes:
+        for width in opts.widths:
+            out = torch.randn(batch_size, width, opts.vocab, device=opts.device)
+            out[:, :, 0] += 2 # mostly blanks, like a trained model
+            assert decoder.decode_batch_greedy(out)[1] == loop_decode(out, idx_to_char)
+            vectorized = time_it(lambda: decoder.decode_batch_greedy(out), opts.repeats)
+            loop = time_it(lambda: loop_decode(out, idx_to_char), opts.repeats)
+            results.append({"batch_size": batch_size, "width": width, "vectorized_ms": vectorized * 1000,
+                            "loop_ms": loop * 1000, "speedup": loop / vectorized})
+            print(f"{batch_size}x{width}: vectorized {vectorized*1000:.2f} ms, loop {loop*1000:.2f} ms, speedup {loop/vectorized:.1f}x")
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+""" Decode throughput of the prefix beam search with and without the character LM
+
+Lines are synthetic: random sentences from a small vocabulary, turned into noisy CTC posteriors.
+The LM is trained on other sentences from the same vocabulary.
+
+Usage (from the repo root):
+    python -m benchmarks.lm_decode --lines 200 --beam-width 30 --processes 1 4
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import char_lm
+import ctc_decoder
+import error_rates
+
+def synthetic_texts(n, random_state, n_words=200, words_per_line=(3, 8)):
+    letters = list("abcdefghijklmnopqrstuvwxyz")
+    vocab = ["".join(random_state.choice(letters, random_state.randint(2, 8))) for _ in range(n_words)]
+    return [" ".join(random_state.choice(vocab, random_state.randint(*words_per_line))) for _ in range(n)]
+
+def synthetic_log_probs(labels, vocab_size, random_state, frames_per_char=3, noise=1.):
+    """ Each character takes frames_per_char frames, followed by a blank; logits are noisy around the truth
+    """
+    path = []
+    for label in labels:
+        path += [label] * frames_per_char + [0]
+    logits = random_state.randn(len(path) + 1, vocab_size) * noise
+    logits[np.arange(len(path)), path] += 4
+    logits[-1, 0] += 4
+    logits -= logits.max(axis=1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200)
+    parser.add_argument('--beam-width', type=int, default=30)
+    parser.add_argument('--processes', type=int, nargs="+", default=[1])
+    parser.add_argument('--lm-order', type=int, default=5)
+    parser.add_argument('--lm-weight', type=float, default=.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='Optional path for JSON results')
+    opts = parser.parse_args()
+
+    random_state = np.random.RandomState(opts.seed)
+    texts = synthetic_texts(opts.lines + 2000, random_state)
+    train_texts, test_texts = texts[opts.lines:], texts[:opts.lines]
+    char_to_idx = {c: i + 1 for i, c in enumerate(sorted(set("".join(texts))))}
+    char_to_idx["|"] = 0
+    idx_to_char = {i: c for c, i in char_to_idx.items()}
+    lm = char_lm.CharNgramLM.train(train_texts, char_to_idx, order=opts.lm_order)
+    log_probs = [synthetic_log_probs([char_to_idx[c] for c in text], len(char_to_idx), random_state) for text in test_texts]
+
+    results = []
+    for use_lm in [False, True]:
+        for processes in opts.processes:
+            lm.cache.clear()
+            search = ctc_decoder.PrefixBeamSearch(idx_to_char, beam_width=opts.beam_width, lm=lm if use_lm else None,
+                                                  lm_weight=opts.lm_weight)
+            decoder = ctc_decoder.BeamSearchDecoder(search, processes=processes)
+            start = time.perf_counter()
+            n_best = decoder.decode(log_probs)
+            seconds = time.perf_counter() - start
+            decoder.close()
+            preds = ["".join(idx_to_char[l] for l in best[0][0]) for best in n_best]
+            cer = np.mean([error_rates.cer(gt, pred) for gt, pred in zip(test_texts, preds)])
+            results.append({"lm": use_lm, "processes": processes, "lines_per_second": len(log_probs) / seconds, "cer": cer})
+            print(f"LM {'on ' if use_lm else 'off'}, {processes} process(es): {len(log_probs)/seconds:.1f} lines/s, CER {cer:.4f}")
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
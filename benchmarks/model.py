@@ -0,0 +1,200 @@
+""" Throughput of the recognizer variants (cnn x rnn_type) on synthetic line images, on CPU
+
+Measures forward, forward+backward (CTC loss) and greedy decoding throughput in images/sec and time-steps/sec,
+plus the peak RSS of each variant. Every variant runs in a fresh process, so peak RSS isn't inherited from
+the previous one and a variant that fails doesn't stop the others.
+
+Usage (from the repo root):
+    python -m benchmarks.model run --cnn default resnet crcr --rnn-types lstm gru --batch-sizes 8 32 --widths 500 1000 --output new.json
+    python -m benchmarks.model compare old.json new.json --threshold .05
+"""
+import argparse
+import json
+import platform
+import resource
+import sys
+import traceback
+from multiprocessing import get_context
+
+import numpy as np
+import torch
+
+from benchmarks.warp import synthetic_line, time_it
+
+CNN_TYPES = ["default", "intermediates", "resnet", "resnet34", "resnet101", "crcr"]
+RNN_TYPES = ["lstm", "gru"]
+METRICS = ["forward_images_per_sec", "forward_backward_images_per_sec", "decode_images_per_sec",
+           "forward_timesteps_per_sec", "forward_backward_timesteps_per_sec"]
+
+def peak_rss_mb():
+    """ Peak resident set size of this process (ru_maxrss is in KB on Linux, bytes on macOS)
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+def synthetic_batch(batch_size, height, width, channels, seed=0):
+    """ Normalized batch, channel, height, width tensor of synthetic lines
+    """
+    imgs = [synthetic_line(height, width, channels, seed=seed + i) for i in range(batch_size)]
+    imgs = np.stack([img if img.ndim == 3 else img[:, :, np.newaxis] for img in imgs]).transpose([0, 3, 1, 2])
+    return torch.from_numpy(imgs.astype(np.float32) / 128.0 - 1.0)
+
+def cnn_out_size(cnn_type, height, channels):
+    """ Feature size per time step of a CNN type, which is what the RNN input must be sized to
+    """
+    from models.basic import CNN
+    from models.CRCR import CRCR
+    cnn = CRCR(nc=channels) if cnn_type == "crcr" else CNN(nc=channels, type=cnn_type)
+    with torch.no_grad():
+        return cnn.eval()(torch.zeros(1, channels, height, 64)).shape[2]
+
+def make_config(opts, cnn_type, rnn_type):
+    import hwr_utils
+    alphabet = {i: chr(32 + i) for i in range(1, opts.alphabet_size)}
+    alphabet[0] = "|"
+    return {"cnn": cnn_type, "rnn_type": rnn_type, "cnn_out_size": cnn_out_size(cnn_type, opts.height, opts.channels),
+            "num_of_channels": opts.channels, "alphabet_size": opts.alphabet_size, "rnn_dimension": opts.rnn_dimension,
+            "rnn_layers": opts.rnn_layers, "recognizer_dropout": .5, "style_encoder": False,
+            "idx_to_char": alphabet, "decoder": hwr_utils.Decoder(alphabet)}
+
+def benchmark_variant(opts, cnn_type, rnn_type):
+    """ All batch sizes and widths of one model; runs in its own process
+    """
+    import crnn
+    torch.manual_seed(opts.seed)
+    torch.set_num_threads(opts.threads)
+    config = make_config(opts, cnn_type, rnn_type)
+    model = crnn.create_CRNN(config)
+    decoder = config["decoder"]
+    ctc = torch.nn.CTCLoss()
+    log_softmax = torch.nn.LogSoftmax(dim=2)
+
+    results = []
+    for batch_size in opts.batch_sizes:
+        for width in opts.widths:
+            line_imgs = synthetic_batch(batch_size, opts.height, width, opts.channels, seed=opts.seed)
+            online = torch.zeros(1, batch_size, 1)
+
+            model.eval()
+            with torch.no_grad():
+                output = model(line_imgs, online)[0] # width, batch, vocab
+                forward = time_it(lambda: model(line_imgs, online), opts.repeats)
+            steps = output.shape[0]
+            label_length = max(1, min(steps // 4, width // 20))
+            labels = torch.randint(1, opts.alphabet_size, (batch_size * label_length,), dtype=torch.int32)
+            label_lengths = torch.full((batch_size,), label_length, dtype=torch.int32)
+            preds_size = torch.full((batch_size,), steps, dtype=torch.int32)
+
+            model.train()
+            def forward_backward():
+                model.zero_grad()
+                loss = ctc(log_softmax(model(line_imgs, online)[0]), labels, preds_size, label_lengths)
+                loss.backward()
+            forward_backward()
+            backward = time_it(forward_backward, opts.repeats)
+
+            output_batch = output.permute(1, 0, 2)
+            decode = time_it(lambda: decoder.decode_batch_greedy(output_batch), opts.repeats)
+
+            result = {"cnn": cnn_type, "rnn_type": rnn_type, "batch_size": batch_size, "width": width, "time_steps": steps,
+                      "forward_ms": forward * 1000, "forward_backward_ms": backward * 1000, "decode_ms": decode * 1000,
+                      "forward_images_per_sec": batch_size / forward,
+                      "forward_backward_images_per_sec": batch_size / backward,
+                      "decode_images_per_sec": batch_size / decode,
+                      "forward_timesteps_per_sec": batch_size * steps / forward,
+                      "forward_backward_timesteps_per_sec": batch_size * steps / backward}
+            results.append(result)
+            print(f"{cnn_type:>13} {rnn_type} {batch_size:>4}x{width:<5}: forward {result['forward_images_per_sec']:8.1f} img/s, "
+                  f"forward+backward {result['forward_backward_images_per_sec']:8.1f} img/s, decode {result['decode_images_per_sec']:9.1f} img/s", flush=True)
+    for result in results:
+        result["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+def _run_variant(args):
+    opts, cnn_type, rnn_type = args
+    try:
+        return benchmark_variant(opts, cnn_type, rnn_type)
+    except Exception as e:
+        traceback.print_exc()
+        return [{"cnn": cnn_type, "rnn_type": rnn_type, "error": repr(e)}]
+
+def run(opts):
+    results = []
+    context = get_context("spawn")
+    for cnn_type in opts.cnn:
+        for rnn_type in opts.rnn_types:
+            with context.Pool(1) as pool: # fresh process: its own peak RSS
+                results.extend(pool.apply(_run_variant, ((opts, cnn_type, rnn_type),)))
+
+    output = {"environment": {"torch": torch.__version__, "python": platform.python_version(), "platform": platform.platform(),
+                              "processor": platform.processor(), "threads": opts.threads},
+              "settings": {k: v for k, v in vars(opts).items() if k not in ("func", "output")},
+              "results": results}
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(output, f, indent=2)
+    return output
+
+def _key(result):
+    return result["cnn"], result["rnn_type"], result.get("batch_size"), result.get("width")
+
+def compare(opts):
+    """ Relative change of every metric between two result files; throughput drops (or RSS growth) beyond
+        threshold are flagged as regressions
+    """
+    with open(opts.old) as f:
+        old = {_key(r): r for r in json.load(f)["results"]}
+    with open(opts.new) as f:
+        new = {_key(r): r for r in json.load(f)["results"]}
+
+    regressions = 0
+    for key in sorted(set(old) & set(new), key=str):
+        before, after = old[key], new[key]
+        if "error" in before or "error" in after:
+            print(f"{key}: error {before.get('error', 'ok')} -> {after.get('error', 'ok')}")
+            continue
+        changes = []
+        for metric in METRICS + ["peak_rss_mb"]:
+            change = after[metric] / before[metric] - 1
+            worse = change > opts.threshold if metric == "peak_rss_mb" else change < -opts.threshold
+            regressions += worse
+            changes.append(f"{metric} {change:+.1%}{' REGRESSION' if worse else ''}")
+        print(f"{key[0]} {key[1]} {key[2]}x{key[3]}: " + ", ".join(changes))
+    for key in sorted(set(old) ^ set(new), key=str):
+        print(f"{key}: only in {'old' if key in old else 'new'}")
+    print(f"{regressions} regressions (threshold {opts.threshold:.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument('--cnn', type=str, nargs="+", default=CNN_TYPES, choices=CNN_TYPES)
+    run_parser.add_argument('--rnn-types', type=str, nargs="+", default=RNN_TYPES, choices=RNN_TYPES)
+    run_parser.add_argument('--batch-sizes', type=int, nargs="+", default=[8, 32])
+    run_parser.add_argument('--widths', type=int, nargs="+", default=[500, 1000])
+    run_parser.add_argument('--height', type=int, default=60)
+    run_parser.add_argument('--channels', type=int, default=1)
+    run_parser.add_argument('--alphabet-size', type=int, default=80)
+    run_parser.add_argument('--rnn-dimension', type=int, default=512)
+    run_parser.add_argument('--rnn-layers', type=int, default=2)
+    run_parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    run_parser.add_argument('--repeats', type=int, default=5)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', type=str, default=None, help='Optional path for JSON results')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument('old', type=str)
+    compare_parser.add_argument('new', type=str)
+    compare_parser.add_argument('--threshold', type=float, default=.05, help='Relative change counted as a regression')
+    compare_parser.set_defaults(func=compare)
+
+    opts = parser.parse_args()
+    result = opts.func(opts)
+    if opts.command == "compare" and result:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
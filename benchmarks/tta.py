@@ -0,0 +1,72 @@
+""" Compare test-time augmentation strategies: CER vs number of warps for string voting and log-probability averaging
+
+The same warped repetitions are scored by every strategy, so differences come only from how they are combined.
+
+Usage (from the repo root; the config should point load_path at a trained model):
+    python -m benchmarks.tta --config ./configs/baseline.yaml --warps 1 3 5 11 21 --batches 20
+"""
+import argparse
+import json
+import time
+
+import torch
+
+import train
+from hwr_utils import calculate_cer
+
+STRATEGIES = ["vote", "mean", "logsumexp"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--warps', type=int, nargs="+", default=[1, 3, 5, 11, 21])
+    parser.add_argument('--strategies', type=str, nargs="+", default=STRATEGIES, choices=STRATEGIES)
+    parser.add_argument('--batches', type=int, default=None, help='Number of test batches to use; default all')
+    parser.add_argument('--output', type=str, default=None, help='Optional path for JSON results')
+    opts = parser.parse_args()
+
+    config, train_dataloader, test_dataloader, *_ = train.build_model(opts.config)
+    # Generate the largest number of warps once and take prefixes
+    config["testing_warp"] = True
+    config["n_warp_iterations"] = max(opts.warps)
+    collate_fn = test_dataloader.collate_fn
+    collate_fn.n_warp_iterations, collate_fn.tta_chunk_size = max(opts.warps), None
+    collate_fn.warp = collate_fn.warp or not config["batch_augmentation"]
+    if config["test_batch_augmenter"]:
+        config["test_batch_augmenter"].warp = True
+    trainer, device = config["trainer"], config["device"]
+    trainer.model.eval()
+
+    errors = {(s, n): 0. for s in opts.strategies for n in opts.warps}
+    seconds = {(s, n): 0. for s in opts.strategies for n in opts.warps}
+    total_lines = 0
+    for i, x in enumerate(test_dataloader):
+        if opts.batches is not None and i >= opts.batches:
+            break
+        line_imgs = x['line_imgs'].to(device)
+        if config["test_batch_augmenter"]:
+            line_imgs = config["test_batch_augmenter"].repetitions(line_imgs)
+        online = x['online'].view(1, -1, 1).to(device)
+        total_lines += len(x['gt'])
+        for strategy in opts.strategies:
+            config["tta_combine"] = strategy
+            for n in opts.warps:
+                start = time.perf_counter()
+                with torch.no_grad():
+                    _, _, preds = trainer.test_warp(line_imgs[:, :n], online, x['gt'])
+                seconds[strategy, n] += time.perf_counter() - start
+                errors[strategy, n] += calculate_cer(preds, x['gt'])[0]
+
+    results = []
+    for strategy in opts.strategies:
+        for n in opts.warps:
+            cer = errors[strategy, n] / max(1, total_lines)
+            results.append({"strategy": strategy, "warps": n, "cer": cer, "seconds": seconds[strategy, n]})
+            print(f"{strategy:>10} {n:>3} warps: CER {cer:.4f}, {seconds[strategy, n]:.2f} s")
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+""" Compare the speed of the fast displacement-field warp against the original scipy griddata warp
+
+Usage (from the repo root):
+    python -m benchmarks.warp --height 60 --widths 500 1000 2000 --repeats 20
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+import grid_distortion
+
+def synthetic_line(height, width, channels=1, seed=0):
+    """ White image with dark random strokes, roughly like a handwritten line
+    """
+    random_state = np.random.RandomState(seed)
+    img = np.full((height, width), 255, dtype=np.uint8)
+    for _ in range(width // 10):
+        y, x = random_state.randint(height // 4, 3 * height // 4), random_state.randint(0, width)
+        img[max(0, y-2):y+2, max(0, x-6):x+6] = random_state.randint(0, 80)
+    if channels == 3:
+        img = np.repeat(img[:, :, np.newaxis], 3, axis=2)
+    return img
+
+def time_it(function, repeats):
+    """ Median wall time of repeated calls, in seconds
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--height', type=int, default=60)
+    parser.add_argument('--widths', type=int, nargs="+", default=[250, 500, 1000, 2000])
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--output', type=str, default=None, help='Optional path for JSON results')
+    opts = parser.parse_args()
+
+    results = []
+    for width in opts.widths:
+        img = synthetic_line(opts.height, width, opts.channels)
+        fast = time_it(lambda: grid_distortion.warp_image(img), opts.repeats)
+        original = time_it(lambda: grid_distortion.warp_image_griddata(img), opts.repeats)
+        results.append({"height": opts.height, "width": width, "fast_ms": fast * 1000,
+                        "griddata_ms": original * 1000, "speedup": original / fast})
+        print(f"{opts.height}x{width}: fast {fast*1000:.2f} ms, griddata {original*1000:.2f} ms, speedup {original/fast:.1f}x")
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import sys
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+
+import string_utils
+
+## Character n-gram language model
+# Interpolated absolute-discounting n-gram model over the recognizer's label indices, trained on the ground truth
+# of the training manifests. Label 0 (the CTC blank) doubles as the sentence boundary: contexts start padded with 0,
+# and P(0 | context) is the probability of the line ending there.
+# Counts are stored per order as sorted context codes with CSR-style rows (offsets, next labels, counts), saved with
+# np.savez. Scoring returns the whole next-label distribution of a context, cached by context, so prefixes shared
+# between beams and batch items are scored only once.
+
+BOUNDARY = 0
+
+class CharNgramLM:
+    def __init__(self, order, chars, contexts, offsets, next_labels, counts, discount=.75, cache_size=200000):
+        """ Use CharNgramLM.train or CharNgramLM.load to create one
+
+        Args:
+            order (int): n
+            chars (list): character of each label index
+            contexts, offsets, next_labels, counts (list): one array per context length 0..order-1
+            discount (float): absolute discount
+            cache_size (int): cached contexts before the cache is cleared
+        """
+        self.order = order
+        self.chars = list(chars)
+        self.vocab_size = len(self.chars)
+        self.contexts = contexts
+        self.offsets = offsets
+        self.next_labels = next_labels
+        self.counts = counts
+        self.discount = discount
+        self.cache_size = cache_size
+        self.cache = {}
+        self._powers = self.vocab_size ** np.arange(max(1, order - 1), dtype=np.int64)
+
+    @staticmethod
+    def train(texts, char_to_idx, order=5, discount=.75):
+        """
+        Args:
+            texts (list): ground truth strings
+            char_to_idx (dict): character -> label index, with 0 for the blank
+            order (int): n
+        """
+        vocab_size = max(char_to_idx.values()) + 1
+        if vocab_size ** (order - 1) >= 2 ** 62:
+            raise Exception("LM order too large for this alphabet")
+        chars = [""] * vocab_size
+        for char, idx in char_to_idx.items():
+            if idx != BOUNDARY:
+                chars[idx] = char
+
+        ngram_counts = [defaultdict(int) for _ in range(order)] # per context length: (context code, label) -> count
+        powers = vocab_size ** np.arange(max(1, order - 1), dtype=np.int64)
+        all_labels, offsets = string_utils.encode_all(texts, string_utils.char_lookup(char_to_idx))
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            labels = [BOUNDARY] * (order - 1) + all_labels[start:end].tolist() + [BOUNDARY]
+            for i in range(order - 1, len(labels)):
+                for m in range(order):
+                    context = labels[i - m:i]
+                    code = int(np.dot(context[::-1], powers[:m])) if m else 0
+                    ngram_counts[m][code, labels[i]] += 1
+
+        contexts, offsets, next_labels, counts = [], [], [], []
+        for m in range(order):
+            keys = np.array(sorted(ngram_counts[m]), dtype=np.int64).reshape(-1, 2)
+            values = np.array([ngram_counts[m][tuple(k)] for k in keys.tolist()], dtype=np.int32)
+            codes, starts = np.unique(keys[:, 0], return_index=True)
+            contexts.append(codes)
+            offsets.append(np.append(starts, len(keys)).astype(np.int64))
+            next_labels.append(keys[:, 1].astype(np.int32))
+            counts.append(values)
+        return CharNgramLM(order, chars, contexts, offsets, next_labels, counts, discount=discount)
+
+    def save(self, path):
+        arrays = {"order": self.order, "discount": self.discount, "chars": np.array(json.dumps(self.chars))}
+        for m in range(self.order):
+            arrays.update({f"contexts_{m}": self.contexts[m], f"offsets_{m}": self.offsets[m],
+                           f"next_labels_{m}": self.next_labels[m], f"counts_{m}": self.counts[m]})
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as f:
+            order = int(f["order"])
+            return CharNgramLM(order, json.loads(str(f["chars"])),
+                               [f[f"contexts_{m}"] for m in range(order)], [f[f"offsets_{m}"] for m in range(order)],
+                               [f[f"next_labels_{m}"] for m in range(order)], [f[f"counts_{m}"] for m in range(order)],
+                               discount=float(f["discount"]))
+
+    def check_alphabet(self, idx_to_char):
+        """ The LM scores label indices, so it must share the recognizer's alphabet
+        """
+        for idx, char in idx_to_char.items():
+            if idx != BOUNDARY and (idx >= self.vocab_size or self.chars[idx] != char):
+                raise Exception("LM alphabet doesn't match the recognizer's; retrain it with `python char_lm.py CONFIG`")
+
+    def _probs(self, context):
+        """ Next-label probabilities after context (tuple of at most order-1 labels, oldest first)
+        """
+        if context in self.cache:
+            return self.cache[context][0]
+        m = len(context)
+        lower = self._probs(context[1:]) if m else np.full(self.vocab_size, 1. / self.vocab_size)
+
+        code = int(np.dot(context[::-1], self._powers[:m])) if m else 0
+        i = np.searchsorted(self.contexts[m], code)
+        if i < len(self.contexts[m]) and self.contexts[m][i] == code:
+            start, end = self.offsets[m][i], self.offsets[m][i + 1]
+            counts = self.counts[m][start:end]
+            total = counts.sum()
+            probs = lower * (self.discount * (end - start) / total)
+            probs[self.next_labels[m][start:end]] += (counts - self.discount) / total
+        else:
+            probs = lower
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[context] = probs, np.log(probs)
+        return probs
+
+    def context(self, prefix):
+        """ Context of a label sequence: its last order-1 labels, padded with the sentence boundary
+        """
+        context = tuple(prefix[-(self.order - 1):]) if self.order > 1 else ()
+        return (BOUNDARY,) * (self.order - 1 - len(context)) + context
+
+    def log_probs(self, context):
+        """ Log probability of every next label (BOUNDARY = end of line) after context; cached
+        """
+        if context not in self.cache:
+            self._probs(context)
+        return self.cache[context][1]
+
+    def score(self, labels):
+        """ Log probability of a whole line of labels, including its end
+        """
+        labels = list(labels)
+        total = 0.
+        for i, label in enumerate(labels + [BOUNDARY]):
+            total += self.log_probs(self.context(labels[:i]))[label]
+        return total
+
+def main(config_path):
+    """ Train an LM on the training manifests of a config and save it to its lm_path
+    """
+    import character_set
+    from hwr_utils import read_config, find_config
+    config = read_config(find_config(config_path))
+    char_to_idx, idx_to_char, char_freq = character_set.make_char_set(config["training_jsons"], root=config["training_root"])
+    texts = []
+    for data_path in config["training_jsons"]:
+        with open(os.path.join(config["training_root"], data_path)) as f:
+            texts.extend(item["gt"] for item in json.load(f))
+    order = config.get("lm_order", 5)
+    lm = CharNgramLM.train(texts, char_to_idx, order=order)
+    lm_path = config.get("lm_path") or os.path.join(config["training_root"], f"char_lm_{order}.npz")
+    lm.save(lm_path)
+    print(f"Trained a {order}-gram character LM on {len(texts)} lines, saved to {lm_path}")
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,94 @@
+import os
+import glob
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+## Checkpoint writing off the training thread
+# With async_checkpoint, save_model snapshots the state dicts to CPU memory (and the stats to a JSON string) on the
+# training thread; a CheckpointWriter then serializes and writes them, and the visdom log, from a background thread.
+# Every file is written to a temporary name next to its destination and renamed over it, so a crash mid-write never
+# leaves a truncated checkpoint, and the BSF directory is mirrored into results_dir with hard links. Because files
+# are always replaced by a rename, never rewritten in place, a later save to results_dir can't modify the linked
+# BSF files.
+
+def cpu_snapshot(obj):
+    """ Copy of a (nested) state dict with every tensor copied to CPU memory
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+def atomic_write(path, write):
+    """ Call write(temporary_path), then rename the temporary file to path
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def atomic_save(obj, path):
+    atomic_write(path, lambda tmp_path: torch.save(obj, tmp_path))
+
+def atomic_write_text(text, path):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(text)
+    atomic_write(path, write)
+
+def mirror(src_dir, dst_dir):
+    """ Hard-link every file of src_dir into dst_dir, replacing existing files; copies if links aren't supported
+    """
+    for src in glob.glob(os.path.join(src_dir, "*")):
+        if not os.path.isfile(src):
+            continue
+        dst = os.path.join(dst_dir, os.path.basename(src))
+        try:
+            atomic_write(dst, lambda tmp_path: os.link(src, tmp_path))
+        except OSError: # e.g. another file system
+            atomic_write(dst, lambda tmp_path: shutil.copy(src, tmp_path))
+
+class CheckpointWriter:
+    def __init__(self, background=True):
+        """ Runs checkpoint writes in order on one background thread, or inline if background is False
+
+            At most one write is in flight: submitting another waits for the previous one, so snapshots
+            don't pile up in memory. Errors of a background write are raised by the next submit/wait/close.
+        """
+        self.background = background
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = None
+
+    def snapshot(self, state_dict):
+        """ CPU copy of a state dict for a background write; without a background thread the state dict
+            itself, since it's written before training resumes
+        """
+        return cpu_snapshot(state_dict) if self.background else state_dict
+
+    def submit(self, function, *args):
+        if not self.background:
+            function(*args)
+            return
+        self.wait()
+        self.pending = self.executor.submit(function, *args)
+
+    def wait(self):
+        """ Block until the write in flight (if any) is on disk
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,11 +1,14 @@
 import warnings
+from collections import Counter
 import torch
 from torch import nn
 from hwr_utils import *
 import os, sys
 from torch.autograd import Variable
+import timing
 #from torchvision.models import resnet
 from models.CRCR import CRCR
+from models.basic import normalize_input
 from models.deprecated_crnn import *
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -115,6 +118,42 @@ def create_Nudger(config):
                             rnn_layers=config["nudger_rnn_layers"], leakyRelu=False, rnn_dropout=config["recognizer_dropout"], rnn_constructor=config["rnn_constructor"])
     return crnn
 
+def combine_log_probs(combined, pred_logits, n_reps, method="mean"):
+    """ Add a forward pass of folded repetitions to the running combination of log probabilities
+
+        All repetitions of an image have the same width, so their frames are already aligned.
+
+    Args:
+        combined: running combination (width, batch, vocab), or None
+        pred_logits: width, reps*batch, vocab (repetition-major)
+        n_reps: number of repetitions in pred_logits
+        method: "mean" sums log probabilities; "logsumexp" sums probabilities (in log space)
+
+    Returns:
+        Tensor: width, batch, vocab
+    """
+    width, n, vocab = pred_logits.shape
+    log_probs = torch.nn.functional.log_softmax(pred_logits, dim=2).view(width, n_reps, n // n_reps, vocab)
+    if method == "mean":
+        part = log_probs.sum(dim=1)
+        return part if combined is None else combined + part
+    elif method == "logsumexp":
+        part = torch.logsumexp(log_probs, dim=1)
+        return part if combined is None else torch.logsumexp(torch.stack([combined, part]), dim=0)
+    else:
+        raise Exception("Unknown TTA combine method {}".format(method))
+
+def finish_log_probs(combined, total_reps, method="mean"):
+    """ Average of the combined log probabilities (geometric mean for "mean", arithmetic mean for "logsumexp")
+
+    Args:
+        total_reps: number of repetitions combined; a (1, batch, 1) tensor if it differs between batch items
+    """
+    if method == "mean":
+        return combined / total_reps
+    else:
+        return combined - torch.log(torch.as_tensor(total_reps, dtype=combined.dtype, device=combined.device))
+
 class TrainerBaseline(json.JSONEncoder):
     def __init__(self, model, optimizer, config, ctc_criterion):
         self.model = model
@@ -124,6 +163,11 @@ class TrainerBaseline(json.JSONEncoder):
         self.idx_to_char = self.config["idx_to_char"]
         self.train_decoder = string_utils.naive_decode
         self.decoder = config["decoder"]
+        self.timer = config["timer"] if "timer" in config else timing.NullTimer()
+        self.training_cer = TrainingCer(self.decoder, config["stats"], freq=config["training_cer_freq"],
+                                        samples=config["training_cer_samples"], background=config["async_training_cer"],
+                                        timer=self.timer if self.timer.enabled else None)
+        self.pending_losses = {} # ctc_on_device: stat name -> [device-side sum of losses, steps] not yet in the stats
 
         if self.config["n_warp_iterations"]:
             print("Using test warp")
@@ -131,44 +175,93 @@ class TrainerBaseline(json.JSONEncoder):
     def default(self, o):
         return None
 
-    def train(self, line_imgs, online, labels, label_lengths, gt, retain_graph=False, step=0):
-        self.model.train()
+    def to_loss_device(self, tensor):
+        """ Logits stay on the model's device with ctc_on_device; otherwise the loss is computed on the CPU
+        """
+        return tensor if self.config["ctc_on_device"] else tensor.cpu()
 
-        pred_tup = self.model(line_imgs, online)
-        pred_logits, rnn_input, *_ = pred_tup[0].cpu(), pred_tup[1], pred_tup[2:]
+    def ctc_loss(self, pred_logits, labels, label_lengths):
+        """ CTC loss on the device of pred_logits
 
-        # Calculate HWR loss
-        preds_size = Variable(torch.IntTensor([pred_logits.size(0)] * pred_logits.size(1)))
+            Targets are moved to that device; the lengths stay on the CPU, since ctc_loss reads them on the
+            host anyway (device lengths would be copied back with a sync).
 
-        output_batch = pred_logits.permute(1, 0, 2) # Width,Batch,Vocab -> Batch, Width, Vocab
-        pred_strs = list(self.decoder.decode_training(output_batch))
+        Args:
+            pred_logits: width, batch, vocab
+        """
+        preds_size = self.preds_size(*pred_logits.shape[:2])
+        labels = labels.to(pred_logits.device, non_blocking=True)
+        return self.ctc_criterion(pred_logits, labels, preds_size, label_lengths.cpu())
+
+    def forward(self, line_imgs, online):
+        """ Model forward pass; uint8 batches (uint8_pipeline) are normalized here, so every model variant gets [-1, 1] floats
+        """
+        return self.model(normalize_input(line_imgs), online)
+
+    def preds_size(self, width, batch_size):
+        """ Input lengths of a batch (every line uses the full padded width)
+        """
+        return torch.full((batch_size,), width, dtype=torch.int32)
+
+    def train(self, line_imgs, online, labels, label_lengths, gt, retain_graph=False, step=0):
+        self.model.train()
+
+        with self.timer("forward"):
+            pred_tup = self.forward(line_imgs, online)
+            pred_logits, rnn_input, *_ = self.to_loss_device(pred_tup[0]), pred_tup[1], pred_tup[2:]
 
         # Get losses
         self.config["logger"].debug("Calculating CTC Loss: {}".format(step))
-        loss_recognizer = self.ctc_criterion(pred_logits, labels, preds_size, label_lengths)
+        with self.timer("loss"):
+            loss_recognizer = self.ctc_loss(pred_logits, labels, label_lengths)
 
         # Backprop
         self.config["logger"].debug("Backpropping: {}".format(step))
-        self.optimizer.zero_grad()
-        loss_recognizer.backward(retain_graph=retain_graph)
-        self.optimizer.step()
+        with self.timer("backward"):
+            self.optimizer.zero_grad()
+            loss_recognizer.backward(retain_graph=retain_graph)
+        with self.timer("step"):
+            self.optimizer.step()
 
-        loss = torch.mean(loss_recognizer.cpu(), 0, keepdim=False).item()
+        loss = self.accumulate_loss("HWR Training Loss", loss_recognizer) # Might need to be divided by batch size?
 
         # Error Rate
-        self.config["stats"]["HWR Training Loss"].accumulate(loss, 1) # Might need to be divided by batch size?
         self.config["logger"].debug("Calculating Error Rate: {}".format(step))
-        err, weight = calculate_cer(pred_strs, gt)
-
-        self.config["logger"].debug("Accumulating stats")
-        self.config["stats"]["Training Error Rate"].accumulate(err, weight)
+        output_batch = pred_logits.detach().permute(1, 0, 2) # Width,Batch,Vocab -> Batch, Width, Vocab
+        err, pred_strs = self.training_cer(output_batch, gt, step)
 
         return loss, err, pred_strs
 
+    def accumulate_loss(self, stat_name, loss_recognizer):
+        """ Add a step's loss to a Stat; with ctc_on_device the sum stays on the device until flush_stats
+
+        Returns:
+            the loss: a float, or a 0-dim device tensor with ctc_on_device
+        """
+        if self.config["ctc_on_device"]:
+            loss = loss_recognizer.detach()
+            if stat_name in self.pending_losses:
+                self.pending_losses[stat_name][0] += loss
+                self.pending_losses[stat_name][1] += 1
+            else:
+                self.pending_losses[stat_name] = [loss.clone(), 1]
+            return loss
+        loss = torch.mean(loss_recognizer.cpu(), 0, keepdim=False).item()
+        self.config["stats"][stat_name].accumulate(loss, 1)
+        return loss
+
+    def flush_stats(self):
+        """ Finish any training CER still being computed in the background, and copy back device-side losses
+        """
+        self.training_cer.flush()
+        for stat_name, (loss_sum, steps) in self.pending_losses.items():
+            self.config["stats"][stat_name].accumulate(loss_sum.item(), steps)
+        self.pending_losses = {}
+
 
-    def test(self, line_imgs, online, gt, force_training=False, nudger=False, validation=True):
+    def test(self, line_imgs, online, gt, force_training=False, nudger=False, validation=True, repetitions=None):
         if self.config["n_warp_iterations"]:
-            return self.test_warp(line_imgs, online, gt, force_training, nudger, validation=validation)
+            return self.test_warp(line_imgs, online, gt, force_training, nudger, validation=validation, repetitions=repetitions)
         else:
             return self.test_normal(line_imgs, online, gt, force_training, nudger, validation=validation)
 
@@ -191,10 +284,10 @@ class TrainerBaseline(json.JSONEncoder):
         else:
             self.model.eval()
 
-        pred_tup = self.model(line_imgs, online)
-        pred_logits, rnn_input, *_ = pred_tup[0].cpu(), pred_tup[1], pred_tup[2:]
+        pred_tup = self.forward(line_imgs, online)
+        rnn_input = pred_tup[1]
 
-        output_batch = pred_logits.permute(1, 0, 2)
+        output_batch = pred_tup[0].permute(1, 0, 2) # decoded on the model's device
         pred_strs = list(self.decoder.decode_test(output_batch))
 
         # Error Rate
@@ -212,7 +305,23 @@ class TrainerBaseline(json.JSONEncoder):
         else:
             self.config["stats"][f"{prefix}Test Error Rate"].accumulate(err, weight, self.config["current_epoch"])
 
-    def test_warp(self, line_imgs, online, gt, force_training=False, nudger=False, validation=True):
+    def test_warp(self, line_imgs, online, gt, force_training=False, nudger=False, validation=True, repetitions=None):
+        """ Test with several augmented repetitions of every image
+
+            tta_combine "vote": each repetition is decoded and the most common label sequence wins
+            tta_combine "mean": frame-wise average of the repetitions' log probabilities, decoded once
+            tta_combine "logsumexp": frame-wise log of the average probability, decoded once
+
+            Repetitions are folded into the batch dimension, so each chunk of repetitions takes one forward pass
+            (or a few, if tta_max_batch caps the number of images per forward).
+            With tta_adaptive, repetitions run in rounds and each line stops as soon as its prediction is settled.
+
+        Args:
+            line_imgs: batch, repetitions, channel, h, w
+            repetitions (WarpRepetitions): if given, repetitions are generated in chunks of tta_chunk_size from this
+                                           instead of being read from line_imgs
+
+        """
         if force_training:
             self.model.train()
         else:
@@ -221,25 +330,34 @@ class TrainerBaseline(json.JSONEncoder):
         #use_lm = config['testing_language_model']
         #n_warp_iterations = config['n_warp_iterations']
 
-        compiled_preds = []
-        # Loop through identical images
-        # batch, repetitions, c/h/w
-        for n in range(0, line_imgs.shape[1]):
-            imgs = line_imgs[:,n,:,:,:]
-            pred_tup = self.model(imgs, online)
-            pred_logits, rnn_input, *_ = pred_tup[0].cpu(), pred_tup[1], pred_tup[2:]
-            output_batch = pred_logits.permute(1, 0, 2)
-            pred_strs = list(self.decoder.decode_test(output_batch))
-            compiled_preds.append(pred_strs) # reps, batch
-
-        compiled_preds = np.array(compiled_preds).transpose((1,0)) # batch, reps
-
-        # Loop through batch items
-        best_preds = []
-        for b in range(0, compiled_preds.shape[0]):
-            preds, counts = np.unique(compiled_preds[b], return_counts=True)
-            best_pred = preds[np.argmax(counts)]
-            best_preds.append(best_pred)
+        if repetitions is None:
+            chunks = [line_imgs]
+        else:
+            chunks = repetitions.chunks(self.config["tta_chunk_size"], device=line_imgs.device)
+
+        batch_size = line_imgs.shape[0]
+        rnn_input = None # for the nudger: the first repetition of every line
+        if self.config["tta_adaptive"]:
+            best_preds, warps, rnn_input = self.adaptive_tta(line_imgs, online, repetitions)
+            self.update_tta_warps(validation, sum(warps), batch_size)
+        elif self.config["tta_combine"] == "vote":
+            votes = [Counter() for b in range(batch_size)]
+            for pred_logits, chunk_rnn_input, n_reps in self.tta_forward(chunks, online):
+                rnn_input = chunk_rnn_input[:, :batch_size] if rnn_input is None else rnn_input
+                output_batch = pred_logits.permute(1, 0, 2) # reps*batch, width, vocab
+                for i, pred in enumerate(self.decoder.decode_test(output_batch, as_string=False)):
+                    votes[i % batch_size][tuple(pred)] += 1
+
+            # Most common label sequence of each batch item
+            best_preds = [string_utils.decode(v.most_common(1)[0][0], self.decoder.char_table) for v in votes]
+        else:
+            combined, total_reps = None, 0
+            for pred_logits, chunk_rnn_input, n_reps in self.tta_forward(chunks, online):
+                rnn_input = chunk_rnn_input[:, :batch_size] if rnn_input is None else rnn_input
+                combined = combine_log_probs(combined, pred_logits, n_reps, self.config["tta_combine"])
+                total_reps += n_reps
+            log_probs = finish_log_probs(combined, total_reps, self.config["tta_combine"])
+            best_preds = list(self.decoder.decode_test(log_probs.permute(1, 0, 2)))
 
         # Error Rate
         if nudger:
@@ -248,7 +366,106 @@ class TrainerBaseline(json.JSONEncoder):
             err, weight = calculate_cer(best_preds, gt)
             self.update_test_cer(validation, err, weight)
             loss = -1 # not calculating test loss here
-            return loss, err, pred_strs
+            return loss, err, best_preds
+
+    def update_tta_warps(self, validation, warps, weight):
+        if validation:
+            self.config["stats"]["Validation TTA Warps"].accumulate(warps, weight)
+        else:
+            self.config["stats"]["Test TTA Warps"].accumulate(warps, weight)
+
+    def adaptive_tta(self, line_imgs, online, repetitions=None):
+        """ Run repetitions in rounds of tta_round_size, only for the lines that haven't settled yet
+
+            A line settles when its most common prediction leads the runner-up by tta_margin votes, or when the
+            posterior mass of that prediction (greedy path probability, summed over the repetitions that voted for it,
+            divided by the number of repetitions) reaches tta_confidence. No line gets more than n_warp_iterations.
+
+        Args:
+            line_imgs: batch, repetitions, channel, h, w
+            online: 1, batch, 1
+            repetitions (WarpRepetitions): if given, repetitions are generated on demand from this
+
+        Returns:
+            tuple: predicted strings, number of repetitions spent on each line, rnn_input of the first repetition
+                   of every line (width, batch, features)
+        """
+        method = self.config["tta_combine"]
+        margin, min_confidence = self.config["tta_margin"], self.config["tta_confidence"]
+        round_size = max(1, self.config["tta_round_size"])
+        max_warps = len(repetitions) if repetitions is not None else line_imgs.shape[1]
+
+        batch_size = line_imgs.shape[0]
+        votes = [Counter() for b in range(batch_size)]
+        mass = [Counter() for b in range(batch_size)] # summed path probability of each hypothesis
+        warps = [0] * batch_size
+        combined, rnn_input = None, None
+        active = list(range(batch_size))
+        done = 0 # repetitions spent on every active line
+        while active and done < max_warps:
+            k = min(round_size, max_warps - done)
+            if repetitions is None:
+                chunk = line_imgs[active, done:done+k]
+            else:
+                chunk = repetitions.take(k, indices=active, device=line_imgs.device)
+            index = torch.tensor(active, device=online.device)
+
+            for pred_logits, chunk_rnn_input, n_reps in self.tta_forward([chunk], online[:, index]):
+                if rnn_input is None: # first forward always covers the whole batch
+                    rnn_input = chunk_rnn_input[:, :batch_size]
+                path_probs = torch.nn.functional.log_softmax(pred_logits, dim=2).max(dim=2)[0].sum(dim=0).exp().tolist()
+                output_batch = pred_logits.permute(1, 0, 2) # reps*active, width, vocab
+                for i, pred in enumerate(self.decoder.decode_test(output_batch, as_string=False)):
+                    b = active[i % len(active)]
+                    votes[b][tuple(pred)] += 1
+                    mass[b][tuple(pred)] += path_probs[i]
+                if method != "vote":
+                    part = combine_log_probs(None if combined is None else combined[:, index], pred_logits, n_reps, method)
+                    if combined is None:
+                        combined = part # first forward always covers the whole batch
+                    else:
+                        combined[:, index] = part
+
+            done += k
+            still_active = []
+            for b in active:
+                warps[b] = done
+                (top, top_votes), *runner_up = votes[b].most_common(2)
+                lead = top_votes - (runner_up[0][1] if runner_up else 0)
+                settled = (margin is not None and lead >= margin) or \
+                          (min_confidence is not None and mass[b][top] / done >= min_confidence)
+                if not settled:
+                    still_active.append(b)
+            active = still_active
+
+        if method == "vote":
+            best_preds = [string_utils.decode(v.most_common(1)[0][0], self.decoder.char_table) for v in votes]
+        else:
+            total_reps = torch.tensor(warps, dtype=combined.dtype, device=combined.device).view(1, -1, 1)
+            log_probs = finish_log_probs(combined, total_reps, method)
+            best_preds = list(self.decoder.decode_test(log_probs.permute(1, 0, 2)))
+        return best_preds, warps, rnn_input
+
+    def tta_forward(self, chunks, online):
+        """ Forward passes over repetitions folded into the batch dimension
+
+        Args:
+            chunks (iterable): tensors of batch, repetitions, channel, h, w
+            online: 1, batch, 1
+
+        Yields:
+            tuple: logits (width, reps*batch, vocab; repetition-major), rnn_input, number of repetitions
+        """
+        max_batch = self.config["tta_max_batch"]
+        for chunk in chunks:
+            b, r = chunk.shape[:2]
+            reps_per_forward = max(1, max_batch // b) if max_batch else r
+            for start in range(0, r, reps_per_forward):
+                reps = chunk[:, start:start+reps_per_forward]
+                n_reps = reps.shape[1]
+                imgs = reps.transpose(0, 1).reshape(n_reps * b, *reps.shape[2:]) # reps*batch, c, h, w
+                pred_tup = self.forward(imgs, online.repeat(1, n_reps, 1))
+                yield pred_tup[0], pred_tup[1], n_reps
 
 class TrainerNudger(TrainerBaseline):
 
@@ -263,10 +480,17 @@ class TrainerNudger(TrainerBaseline):
         self.recognizer_rnn = self.model.rnn
         self.train_baseline = train_baseline
         self.decoder = config["decoder"]
+        self.pending_losses = {}
 
     def default(self, o):
         return None
 
+    def flush_stats(self):
+        self.baseline_trainer.flush_stats()
+        for stat_name, (loss_sum, steps) in self.pending_losses.items():
+            self.config["stats"][stat_name].accumulate(loss_sum.item(), steps)
+        self.pending_losses = {}
+
     def train(self, line_imgs, online, labels, label_lengths, gt, retain_graph=False, step=0):
         self.nudger.train()
 
@@ -277,14 +501,12 @@ class TrainerNudger(TrainerBaseline):
         else:
             baseline_prediction, rnn_input = self.baseline_trainer.test(line_imgs, online, gt, force_training=True, update_stats=False)
 
-        pred_logits_nudged, nudged_rnn_input, *_ = [x.cpu() for x in self.nudger(rnn_input, self.recognizer_rnn) if not x is None]
-        preds_size = Variable(torch.IntTensor([pred_logits_nudged.size(0)] * pred_logits_nudged.size(1)))
+        pred_logits_nudged, nudged_rnn_input, *_ = [self.to_loss_device(x) for x in self.nudger(rnn_input, self.recognizer_rnn) if not x is None]
         output_batch = pred_logits_nudged.permute(1, 0, 2)
         pred_strs = list(self.decoder.decode_training(output_batch))
 
         self.config["logger"].debug("Calculating CTC Loss (nudged): {}".format(step))
-        loss_recognizer_nudged = self.ctc_criterion(pred_logits_nudged, labels, preds_size, label_lengths)
-        loss = torch.mean(loss_recognizer_nudged.cpu(), 0, keepdim=False).item()
+        loss_recognizer_nudged = self.ctc_loss(pred_logits_nudged, labels, label_lengths)
 
         # Backprop
         self.optimizer.zero_grad()
@@ -297,17 +519,17 @@ class TrainerNudger(TrainerBaseline):
             self.model.my_train()
 
         # Error Rate
-        self.config["stats"]["Nudged Training Loss"].accumulate(loss, 1)  # Might need to be divided by batch size?
+        loss = self.accumulate_loss("Nudged Training Loss", loss_recognizer_nudged)  # Might need to be divided by batch size?
         err, weight, pred_str = calculate_cer(pred_strs, gt)
         self.config["stats"]["Nudged Training Error Rate"].accumulate(err, weight)
 
         return loss, err, pred_str
 
-    def test(self, line_imgs, online, gt, validation=True):
+    def test(self, line_imgs, online, gt, validation=True, repetitions=None):
         self.nudger.eval()
         rnn_input = self.baseline_trainer.test(line_imgs, online, gt, nudger=True)
 
-        pred_logits_nudged, nudged_rnn_input, *_ = [x.cpu() for x in self.nudger(rnn_input, self.recognizer_rnn) if not x is None]
+        pred_logits_nudged, nudged_rnn_input, *_ = [self.to_loss_device(x) for x in self.nudger(rnn_input, self.recognizer_rnn) if not x is None]
         # preds_size = Variable(torch.IntTensor([pred_logits_nudged.size(0)] * pred_logits_nudged.size(1)))
         output_batch = pred_logits_nudged.permute(1, 0, 2)
         pred_strs = list(self.decoder.decode_test(output_batch))
@@ -0,0 +1,247 @@
+import math
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+
+import char_lm
+
+## CTC prefix beam search
+# Built-in replacement for the ctcdecode package. Each line is decoded independently in pure Python/NumPy,
+# and the lines of a batch are spread over a process pool.
+# An optional lexicon (a character trie of allowed words) removes prefixes that can't become a lexicon word,
+# and an optional character LM (char_lm.CharNgramLM) rescores every extension.
+
+NEG_INF = -float("inf")
+
+def logaddexp(a, b):
+    """ log(exp(a) + exp(b)) for Python floats; faster than np.logaddexp on scalars
+    """
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
+
+class Trie:
+    """ Character trie of allowed words; each node is a dict of child nodes, with the key None marking a word end
+    """
+    def __init__(self, words=()):
+        self.root = {}
+        self.alphabet = set()
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+            self.alphabet.add(char)
+        node[None] = True
+
+    def __contains__(self, word):
+        node = self.root
+        for char in word:
+            if char not in node:
+                return False
+            node = node[char]
+        return None in node
+
+    @staticmethod
+    def from_file(path):
+        """ Lexicon file with whitespace-separated words (e.g. one per line)
+        """
+        with open(path, encoding="utf-8") as f:
+            return Trie(f.read().split())
+
+class PrefixBeamSearch:
+    def __init__(self, idx_to_char, beam_width=30, prune_threshold=-12., lexicon=None, n_best=1, blank=0,
+                 lm=None, lm_weight=.5, insertion_bonus=0.):
+        """ CTC prefix beam search for a single line
+
+        Args:
+            idx_to_char (dict): label index -> character
+            beam_width (int): prefixes kept after each frame
+            prune_threshold (float): characters with a log probability below this are not considered at a frame
+            lexicon (Trie): if given, prefixes must spell lexicon words; characters that don't occur in any
+                            lexicon word (spaces, punctuation, ...) act as word separators
+            n_best (int): number of hypotheses returned
+            blank (int): index of the CTC blank
+            lm (char_lm.CharNgramLM): character LM over the same label indices
+            lm_weight (float): weight of the LM log probability
+            insertion_bonus (float): log score added per character, to offset the LM's preference for short lines
+        """
+        self.idx_to_char = idx_to_char
+        self.beam_width = beam_width
+        self.prune_threshold = prune_threshold
+        self.lexicon = lexicon
+        self.n_best = n_best
+        self.blank = blank
+        self.lm = lm
+        self.lm_weight = lm_weight
+        self.insertion_bonus = insertion_bonus
+
+    def _step_lexicon(self, node, label):
+        """ Trie node after appending label to a prefix whose current word is at node; None if not allowed
+        """
+        char = self.idx_to_char[label]
+        if char in self.lexicon.alphabet:
+            return node.get(char)
+        # Separator: the word before it must be complete (or empty)
+        if node is self.lexicon.root or None in node:
+            return self.lexicon.root
+        return None
+
+    def extend(self, prefix, label, state):
+        """ Hook for rescoring an extension of prefix by label (e.g. with a language model)
+
+        Returns:
+            tuple: log score added to the extension, new state; or None if the extension is not allowed
+        """
+        if self.lexicon is not None:
+            state = self._step_lexicon(state, label)
+            if state is None:
+                return None
+        score = self.insertion_bonus
+        if self.lm is not None:
+            score += self.lm_weight * self.lm.log_probs(self.lm.context(prefix))[label]
+        return score, state
+
+    def initial_state(self):
+        return self.lexicon.root if self.lexicon is not None else None
+
+    def final_score(self, prefix, state):
+        """ Log score added once a line is finished; None if the prefix is not a valid ending
+        """
+        if self.lexicon is not None and not (state is self.lexicon.root or None in state):
+            return None
+        if self.lm is not None:
+            return self.lm_weight * self.lm.log_probs(self.lm.context(prefix))[char_lm.BOUNDARY]
+        return 0.
+
+    def decode(self, log_probs):
+        """
+        Args:
+            log_probs (np.array): width, vocab log probabilities of one line
+
+        Returns:
+            list: n_best (label tuple, log score) pairs, best first
+        """
+        # prefix -> [log prob ending in blank, log prob ending in non-blank, extension score, state]
+        beams = {(): [0., NEG_INF, 0., self.initial_state()]}
+        for frame in log_probs:
+            candidates = np.flatnonzero(frame >= self.prune_threshold)
+            if candidates.size == 0:
+                candidates = [int(frame.argmax())]
+            frame = frame.tolist()
+            next_beams = defaultdict(lambda: [NEG_INF, NEG_INF, 0., None])
+            for prefix, (p_blank, p_char, score, state) in beams.items():
+                p_total = logaddexp(p_blank, p_char)
+                last = prefix[-1] if prefix else None
+                for label in candidates:
+                    label = int(label)
+                    p = frame[label]
+                    if label == self.blank:
+                        entry = next_beams[prefix]
+                        entry[0] = logaddexp(entry[0], p_total + p)
+                        entry[2], entry[3] = score, state
+                        continue
+
+                    if label == last:
+                        # Repeated character without a blank in between collapses into the same prefix
+                        entry = next_beams[prefix]
+                        entry[1] = logaddexp(entry[1], p_char + p)
+                        entry[2], entry[3] = score, state
+                        p_extend = p_blank + p # a blank in between makes it a new character
+                    else:
+                        p_extend = p_total + p
+                    if p_extend == NEG_INF:
+                        continue
+
+                    new_prefix = prefix + (label,)
+                    if new_prefix not in next_beams:
+                        extension = self.extend(prefix, label, state)
+                        if extension is None:
+                            continue
+                        next_beams[new_prefix] = [NEG_INF, NEG_INF, score + extension[0], extension[1]]
+                    entry = next_beams[new_prefix]
+                    entry[1] = logaddexp(entry[1], p_extend)
+
+            ranked = sorted(next_beams.items(), key=lambda kv: logaddexp(kv[1][0], kv[1][1]) + kv[1][2], reverse=True)
+            beams = dict(ranked[:self.beam_width])
+
+        results = []
+        for prefix, (p_blank, p_char, score, state) in beams.items():
+            final = self.final_score(prefix, state)
+            if final is not None:
+                results.append((prefix, float(logaddexp(p_blank, p_char) + score + final)))
+        if not results: # nothing valid (e.g. no lexicon word fits), keep the unconstrained ranking
+            results = [(prefix, float(logaddexp(p_blank, p_char) + score)) for prefix, (p_blank, p_char, score, state) in beams.items()]
+        results.sort(key=lambda r: r[1], reverse=True)
+        return results[:self.n_best]
+
+_worker_search = None
+
+def _init_worker(search):
+    global _worker_search
+    _worker_search = search
+
+def _decode_worker(log_probs):
+    return _worker_search.decode(log_probs)
+
+class BeamSearchDecoder:
+    def __init__(self, search, processes=3):
+        """ Decodes the lines of a batch in parallel
+
+        Args:
+            search (PrefixBeamSearch):
+            processes (int): worker processes; 0 or 1 decodes in this process
+        """
+        self.search = search
+        self.processes = processes
+        self._pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def pool(self):
+        if self._pool is None:
+            # The search (with its lexicon) is sent to each worker once, not with every line
+            self._pool = Pool(self.processes, initializer=_init_worker, initargs=(self.search,))
+        return self._pool
+
+    def decode(self, log_probs):
+        """
+        Args:
+            log_probs (np.array): batch, width, vocab log probabilities
+
+        Returns:
+            list: for each line, a list of n_best (label tuple, log score) pairs
+        """
+        if self.processes and self.processes > 1 and len(log_probs) > 1:
+            return self.pool().map(_decode_worker, list(log_probs))
+        return [self.search.decode(line) for line in log_probs]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+def from_config(config):
+    """ BeamSearchDecoder using the beam_* settings of a config
+    """
+    lexicon = Trie.from_file(config["beam_lexicon"]) if config["beam_lexicon"] else None
+    lm = None
+    if config["lm_path"]:
+        lm = char_lm.CharNgramLM.load(config["lm_path"])
+        lm.check_alphabet(config["idx_to_char"])
+    search = PrefixBeamSearch(config["idx_to_char"], beam_width=config["beam_width"],
+                              prune_threshold=config["beam_prune_threshold"], lexicon=lexicon,
+                              n_best=config["beam_n_best"], lm=lm, lm_weight=config["lm_weight"],
+                              insertion_bonus=config["lm_insertion_bonus"])
+    return BeamSearchDecoder(search, processes=config["beam_processes"])
@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-from scipy.interpolate import griddata
 import sys
 
 INTERPOLATION = {
@@ -9,25 +8,50 @@ INTERPOLATION = {
 }
 cv2.setNumThreads(0)
 
-def occlude(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger=None, noise_type=None):
+def occlude(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger=None, noise_type=None, out=None):
     if occlusion_freq:
-        return _occlude(img, occlusion_size, occlusion_freq, occlusion_level, logger)
+        return _occlude(img, occlusion_size, occlusion_freq, occlusion_level, logger, out=out)
     else:
         if noise_type is None:
             noise_type = "gaussian"
-        return noise(img, occlusion_level=occlusion_level, logger=logger, noise_type=noise_type)
+        return noise(img, occlusion_level=occlusion_level, logger=logger, noise_type=noise_type, out=out)
 
-def _occlude(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger=None):
+def occlusion_mask(shape, occlusion_size=1, occlusion_freq=.5, random_state=None):
+    """ Boolean H x W mask of occluded pixels
+
+        The mask is drawn at low resolution (one uniform draw per occlusion_size x occlusion_size block,
+        thresholded at occlusion_freq) and upsampled, so larger blocks are cheaper than single pixels.
+
+    Args:
+        shape (tuple): image shape; only H, W are used
+        occlusion_size (int): square dimension in pixels of each occluded block; None = 1
+        occlusion_freq (float): probability that a block is occluded
+        random_state (np.random.RandomState):
+
+    Returns:
+        np.array: bool, H x W
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    h, w = shape[:2]
+    size = max(1, int(occlusion_size or 1))
+    mask = random_state.random_sample((-(-h // size), -(-w // size))) < occlusion_freq
+    if size > 1:
+        mask = cv2.resize(mask.view(np.uint8), (mask.shape[1]*size, mask.shape[0]*size), interpolation=cv2.INTER_NEAREST)
+        mask = mask[:h, :w].view(bool)
+    return mask
+
+def _occlude(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger=None, out=None, random_state=None):
     """
         Occlusion frequency : between 0% and this number will be occluded
         Occlusion level: maximum occlusion change (multiplier); each pixel to be occluded has a random occlusion probability;
                          then it is multiplied/divided by at most the occlusion level
+        Occlusion size: occluded pixels come in occlusion_size x occlusion_size blocks
 
         NOT IMPLEMENTED:
         OTHER OPTIONS:
             RANDOM OCCLUSION THRESHOLD
             RANDOM OCCLUSION LEVEL (within range)
-            OCCLUSION SIZE
     Args:
         img:
         occlusion_size:
@@ -35,28 +59,33 @@ def _occlude(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger
         occlusion_level: just "dim" these pixels a random amount; 1 - white, 0 - original image
         occlusion
         logger:
+        out (np.array): optional buffer with the same shape as img to write into (may be img itself);
+                        must be a float array unless occlusion_level is 1
+        random_state (np.random.RandomState):
 
     Returns:
-
+        np.array: occluded image (out, if given)
     """
     # Randomly choose occlusion frequency between 0 and specified occlusion
     # H X W X Channel
-    random_state = np.random.RandomState()
-    occlusion_freq = random_state.uniform(0, occlusion_freq) #
-    binary_mask = random_state.choice(2, img.shape, p=[occlusion_freq, 1-occlusion_freq])
-    #logger.debug(binary_mask)
-    if occlusion_level==1:
-        occlusion = np.where(binary_mask==0, 255, img) # replace 0's with white
-    else: # 1 = .3
+    if random_state is None:
+        random_state = np.random.RandomState()
+    occlusion_freq = random_state.uniform(0, occlusion_freq)
+    mask = occlusion_mask(img.shape, occlusion_size, occlusion_freq, random_state)
+
+    if out is None:
+        out = img.copy() if occlusion_level == 1 else img.astype(np.float32)
+    elif out is not img:
+        np.copyto(out, img, casting="unsafe")
+
+    if occlusion_level == 1:
+        out[mask] = 255 # replace occluded pixels with white
+    else: # random noise, only drawn for the occluded pixels
         sd = occlusion_level / 2 # ~95% of observations will be less extreme; if occlusion_level=1, we set so 95% of multipliers are <1
-        random_mask = random_state.randn(*img.shape, ) * sd # * 2 - occlusion_level # min -occlusion, max occlusion
-        random_mask = np.clip(random_mask, -1, 1)
-        if False: # randomly whiten to different levels
-            occlusion = np.where(binary_mask == 0, (1-random_mask)*img+255*random_mask, img)  # replace 0's with white
-        else: # random noise
-            random_mask = np.minimum((random_mask + 1) * img, 255)
-            occlusion = np.where(binary_mask == 0, random_mask, img)
-    return occlusion
+        occluded = out[mask]
+        multiplier = np.clip(random_state.randn(*occluded.shape) * sd, -1, 1) + 1
+        out[mask] = np.minimum(multiplier * occluded, 255)
+    return out
 
 # def noise(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger=None):
 #     """
@@ -92,20 +121,15 @@ def _occlude(img, occlusion_size=1, occlusion_freq=.5, occlusion_level=1, logger
 #
 #     return occlusion
 
-def warp_image(img, random_state=None, **kwargs):
-    if random_state is None:
-        random_state = np.random.RandomState()
-
+def _mesh_params(h, w, kwargs):
+    """ Mesh interval/std from kwargs; by default, intervals are changed so the mesh fits the image exactly
+    """
     w_mesh_interval = kwargs.get('w_mesh_interval', 25)
     w_mesh_std = kwargs.get('w_mesh_std', 3.0)
 
     h_mesh_interval = kwargs.get('h_mesh_interval', 25)
     h_mesh_std = kwargs.get('h_mesh_std', 3.0)
 
-    interpolation_method = kwargs.get('interpolation', 'linear')
-
-    h, w = img.shape[:2]
-
     if kwargs.get("fit_interval_to_image", True):
         # Change interval so it fits the image size
         w_ratio = w / float(w_mesh_interval)
@@ -117,19 +141,96 @@ def warp_image(img, random_state=None, **kwargs):
         w_mesh_interval = w / w_ratio
         h_mesh_interval = h / h_ratio
         ############################################
+    return w_mesh_interval, w_mesh_std, h_mesh_interval, h_mesh_std
+
+def _draw_grid_lines(img, source):
+    if len(img.shape) == 2 or img.shape[2]==1: # if already grayscale
+        color = 0
+    else:
+        color = np.array([0,0,255])
+    for s in source:
+        img[int(s[0]):int(s[0])+1,:] = color
+        img[:,int(s[1]):int(s[1])+1] = color
+
+def _interpolation_matrix(n_pixels, points):
+    """ Matrix that linearly interpolates values at control points onto every pixel
+
+    Args:
+        n_pixels (int): number of pixels along this axis
+        points (np.array): increasing control point coordinates along this axis
+
+    Returns:
+        np.array: n_pixels x len(points), each row has (at most) two non-zero weights summing to 1
+    """
+    pixels = np.arange(n_pixels, dtype=np.float32)
+    right = np.clip(np.searchsorted(points, pixels, side="right"), 1, len(points)-1)
+    left = right - 1
+    t = np.clip((pixels - points[left]) / (points[right] - points[left]), 0, 1)
+    matrix = np.zeros((n_pixels, len(points)), dtype=np.float32)
+    matrix[np.arange(n_pixels), left] = 1 - t
+    matrix[np.arange(n_pixels), right] += t
+    return matrix
+
+def warp_image(img, random_state=None, **kwargs):
+    """ Random elastic mesh distortion
+
+        Control points every ~w_mesh_interval/h_mesh_interval pixels get a random normal displacement;
+        the coarse displacement grid is bilinearly upsampled to a dense sampling map and applied with cv2.remap.
+        This is a fast equivalent of warp_image_griddata, which triangulates the perturbed mesh with scipy.
+
+    Args:
+        img (np.array): H x W or H x W x C image
+        random_state (np.random.RandomState):
+        **kwargs: w_mesh_interval, w_mesh_std, h_mesh_interval, h_mesh_std, interpolation, fit_interval_to_image, draw_grid_lines
+
+    Returns:
+        np.array: warped image, same size as img (a trivial channel axis is dropped by cv2)
+    """
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    interpolation_method = kwargs.get('interpolation', 'linear')
+
+    h, w = img.shape[:2]
+    w_mesh_interval, w_mesh_std, h_mesh_interval, h_mesh_std = _mesh_params(h, w, kwargs)
+
+    # Get control points
+    rows = np.arange(0, h+h_mesh_interval, h_mesh_interval, dtype=np.float32)
+    cols = np.arange(0, w+w_mesh_interval, w_mesh_interval, dtype=np.float32)
+
+    if kwargs.get("draw_grid_lines", False):
+        _draw_grid_lines(img, np.stack(np.meshgrid(rows, cols, indexing="ij"), axis=-1).reshape(-1, 2))
+
+    # Perturb control points, upsample the displacements to every pixel
+    dy = random_state.normal(0.0, h_mesh_std, size=(len(rows), len(cols))).astype(np.float32)
+    dx = random_state.normal(0.0, w_mesh_std, size=(len(rows), len(cols))).astype(np.float32)
+    row_weights = _interpolation_matrix(h, rows)
+    col_weights = _interpolation_matrix(w, cols).T
+    map_y = row_weights @ dy @ col_weights + np.arange(h, dtype=np.float32)[:, np.newaxis]
+    map_x = row_weights @ dx @ col_weights + np.arange(w, dtype=np.float32)[np.newaxis, :]
+
+    warped = cv2.remap(img, map_x, map_y, INTERPOLATION[interpolation_method], borderValue=(255,255,255))
+    return warped
+
+def warp_image_griddata(img, random_state=None, **kwargs):
+    """ Original warp: interpolates the perturbed mesh with scipy griddata (Delaunay triangulation); much slower
+    """
+    from scipy.interpolate import griddata
+    
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    interpolation_method = kwargs.get('interpolation', 'linear')
+
+    h, w = img.shape[:2]
+    w_mesh_interval, w_mesh_std, h_mesh_interval, h_mesh_std = _mesh_params(h, w, kwargs)
 
     # Get control points
     source = np.mgrid[0:h+h_mesh_interval:h_mesh_interval, 0:w+w_mesh_interval:w_mesh_interval]
     source = source.transpose(1,2,0).reshape(-1,2)
 
     if kwargs.get("draw_grid_lines", False):
-        if len(img.shape) == 2 or img.shape[2]==1: # if already grayscale
-            color = 0
-        else:
-            color = np.array([0,0,255])
-        for s in source:
-            img[int(s[0]):int(s[0])+1,:] = color
-            img[:,int(s[1]):int(s[1])+1] = color
+        _draw_grid_lines(img, source)
 
     # Perturb source control points
     destination = source.copy()
@@ -146,24 +247,32 @@ def warp_image(img, random_state=None, **kwargs):
 
     return warped
 
-def noise(img, occlusion_level=1, logger=None, noise_type="gaussian"):
+def noise(img, occlusion_level=1, logger=None, noise_type="gaussian", out=None):
     if noise_type == "gaussian":
-        return gaussian_noise(img, occlusion_level=occlusion_level, logger=logger)
+        return gaussian_noise(img, occlusion_level=occlusion_level, logger=logger, out=out)
     else:
         raise Exception("Not implemented")
 
-def gaussian_noise(img, occlusion_level=1, logger=None):
+def gaussian_noise(img, occlusion_level=1, logger=None, out=None, random_state=None):
     """
         occlusion_level: .1 - light haze, 1 heavy
+        out: optional float buffer with the same shape as img to write into (may be img itself)
 
     """
+    if random_state is None:
+        random_state = np.random.RandomState()
+    if out is None:
+        out = img.astype(np.float32)
+    elif out is not img:
+        np.copyto(out, img, casting="unsafe")
 
-    random_state = np.random.RandomState()
     sd = occlusion_level / 2  # ~95% of observations will be less extreme; if occlusion_level=1, we set so 95% of multipliers are <1
-    noise_mask = random_state.randn(*img.shape, ) * sd  # * 2 - occlusion_level # min -occlusion, max occlusion
-    noise_mask = np.clip(noise_mask, -1, 1) * 255/2
-    noisy_img = np.clip(img + noise_mask, 0, 255)
-    return noisy_img
+    noise_mask = random_state.randn(*img.shape) * sd  # * 2 - occlusion_level # min -occlusion, max occlusion
+    np.clip(noise_mask, -1, 1, out=noise_mask)
+    noise_mask *= 255/2
+    out += noise_mask
+    np.clip(out, 0, 255, out=out)
+    return out
 
     # elif noise_typ == "s&p":
     #     row, col, ch = image.shape
@@ -5,26 +5,121 @@ import torch
 from torch.utils.data import Dataset
 from torch.autograd import Variable
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 import cv2
 import numpy as np
 
 import random
 import string_utils
+from PIL import Image
 
 import grid_distortion
+import line_store
 from hwr_utils import unpickle_it
-PADDING_CONSTANT = 0
+PADDING_CONSTANT = 0 # normalized padding value
+PADDING_PIXEL = 128 # the same, for uint8 images
 ONLINE_JSON_PATH = ''
 
-def collate(batch, device="cpu", n_warp_iterations=None, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1):
+def collate(batch, device="cpu", n_warp_iterations=None, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1,
+            tta_chunk_size=None, tta_workers=4):
     if n_warp_iterations:
         #print("USING COLLATE WITH REPETITION")
-        return collate_repetition(batch, device, n_warp_iterations, warp, occlusion_freq, occlusion_size, occlusion_level=occlusion_level)
+        return collate_repetition(batch, device, n_warp_iterations, warp, occlusion_freq, occlusion_size, occlusion_level=occlusion_level,
+                                  tta_chunk_size=tta_chunk_size, tta_workers=tta_workers)
     else:
         return collate_basic(batch, device)
 
+class Collate:
+    def __init__(self, n_warp_iterations=None, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1,
+                 tta_chunk_size=None, tta_workers=4):
+        """ Picklable collate_fn (a lambda can't be sent to spawned workers); returns CPU tensors
+
+            Arguments are those of collate; they can be changed between epochs (e.g. collate_fn.warp = True),
+            unless the DataLoader keeps persistent workers.
+        """
+        self.n_warp_iterations = n_warp_iterations
+        self.warp = warp
+        self.occlusion_freq = occlusion_freq
+        self.occlusion_size = occlusion_size
+        self.occlusion_level = occlusion_level
+        self.tta_chunk_size = tta_chunk_size
+        self.tta_workers = tta_workers
+
+    def __call__(self, batch):
+        return collate(batch, device="cpu", n_warp_iterations=self.n_warp_iterations, warp=self.warp,
+                       occlusion_freq=self.occlusion_freq, occlusion_size=self.occlusion_size,
+                       occlusion_level=self.occlusion_level, tta_chunk_size=self.tta_chunk_size, tta_workers=self.tta_workers)
+
+class DevicePrefetcher:
+    def __init__(self, dataloader, device, depth=2, keys=("line_imgs", "online")):
+        """ Iterates over a DataLoader, copying the next `depth` batches to the device on a side CUDA stream
+            while the current batch is being used
+
+        Args:
+            dataloader (DataLoader): yields dicts of CPU tensors (pinned, for the copies to be asynchronous)
+            device: target device
+            depth (int): batches staged ahead
+            keys (tuple): entries of the batch dict to move; the rest stay on the CPU
+        """
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.depth = max(1, depth)
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        # dataset, batch_sampler, collate_fn, ... of the wrapped DataLoader
+        return getattr(self.__dict__["dataloader"], name)
+
+    def _stage(self, batch, stream):
+        with torch.cuda.stream(stream):
+            for key in self.keys:
+                if torch.is_tensor(batch.get(key)):
+                    batch[key] = batch[key].to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+    def _ready(self, staged):
+        batch, event = staged
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(event)
+        for key in self.keys:
+            if torch.is_tensor(batch.get(key)) and batch[key].is_cuda:
+                batch[key].record_stream(current) # memory was allocated on the side stream
+        return batch
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            yield from self.dataloader
+            return
+        stream = torch.cuda.Stream(self.device)
+        staged = deque()
+        for batch in self.dataloader:
+            staged.append(self._stage(batch, stream))
+            if len(staged) > self.depth:
+                yield self._ready(staged.popleft())
+        while staged:
+            yield self._ready(staged.popleft())
+
+def to_uint8(img):
+    """ Round/clip an image in [0, 255] (e.g. after a float occlusion) back to uint8
+    """
+    if img.dtype == np.uint8:
+        return img
+    return np.clip(np.rint(img), 0, 255).astype(np.uint8)
+
+def padded_batch(shape, uint8=False):
+    """ Empty batch filled with the padding value, uint8 (see HwDataset uint8) or normalized float32
+    """
+    if uint8:
+        return np.full(shape, PADDING_PIXEL, dtype=np.uint8)
+    return np.full(shape, PADDING_CONSTANT, dtype=np.float32)
+
 def collate_basic(batch, device="cpu"):
     batch = [b for b in batch if b is not None]
     #These all should be the same size or error
@@ -41,7 +136,7 @@ def collate_basic(batch, device="cpu"):
     all_labels = []
     label_lengths = []
 
-    input_batch = np.full((len(batch), dim0, dim1, dim2), PADDING_CONSTANT).astype(np.float32)
+    input_batch = padded_batch((len(batch), dim0, dim1, dim2), uint8=batch[0]['line_img'].dtype == np.uint8)
     for i in range(len(batch)):
         b_img = batch[i]['line_img']
         input_batch[i,:,:b_img.shape[1],:] = b_img
@@ -66,10 +161,110 @@ def collate_basic(batch, device="cpu"):
         "gt": [b['gt'] for b in batch],
         "writer_id": torch.FloatTensor([b['writer_id'] for b in batch]),
         "paths": [b["path"] for b in batch],
-        "online": online
+        "online": online,
+        "padding_ratio": 1 - sum([b['line_img'].shape[1] for b in batch]) / (len(batch) * dim1)
     }
 
-def collate_repetition(batch, device="cpu", n_warp_iterations=21, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1):
+def augment_repetition(img, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1):
+    """ One test-time augmentation of an image in [0, 255]
+
+    Returns:
+        np.array: H, W, C in [0, 255]
+    """
+    new_img = img.copy()
+    if warp:
+        new_img = grid_distortion.warp_image(new_img)
+    if occlusion_size and occlusion_freq:
+        new_img = grid_distortion.occlude(new_img, occlusion_freq=occlusion_freq, occlusion_size=occlusion_size, occlusion_level=occlusion_level,
+                                          out=new_img if new_img.dtype == np.float32 or occlusion_level == 1 else None)
+
+    # Add channel dimension, since resize and warp only keep non-trivial channel axis
+    if len(new_img.shape) == 2:
+        new_img = new_img[:, :, np.newaxis]
+    return new_img
+
+class WarpRepetitions:
+    """ Test-time augmentation repetitions of a batch, generated on demand instead of all at once in the collate
+
+        Only the unpadded uint8 source images are kept; repetitions are warped/occluded in chunks by a thread pool
+        when the trainer asks for them, so memory scales with the chunk size rather than n_warp_iterations.
+        Safe to send from DataLoader workers; the thread pool is only created in the process that consumes it.
+    """
+    _pools = {}
+
+    def __init__(self, images, shape, n_warp_iterations, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1, workers=4,
+                 uint8=False):
+        """
+        Args:
+            images (list): uint8 H x W x C images in [0, 255], one per batch item
+            shape (tuple): height, max width, channels of the padded batch
+            n_warp_iterations (int): number of repetitions per image
+            workers (int): threads used to generate repetitions
+            uint8 (bool): return uint8 repetitions in [0, 255] instead of normalized float ones
+        """
+        self.images = images
+        self.shape = shape
+        self.n_warp_iterations = n_warp_iterations
+        self.augment_kwargs = {"warp": warp, "occlusion_freq": occlusion_freq, "occlusion_size": occlusion_size, "occlusion_level": occlusion_level}
+        self.workers = workers
+        self.uint8 = uint8
+        self.transform = None # optional function applied to each chunk tensor, e.g. batch augmentation
+
+    def __len__(self):
+        return self.n_warp_iterations
+
+    def pool(self):
+        if self.workers not in WarpRepetitions._pools:
+            WarpRepetitions._pools[self.workers] = ThreadPoolExecutor(max_workers=self.workers)
+        return WarpRepetitions._pools[self.workers]
+
+    def _fill(self, out, b_i, r_i, img):
+        new_img = augment_repetition(img, **self.augment_kwargs)
+        if self.uint8:
+            out[b_i, r_i, :, :, :img.shape[1]] = to_uint8(new_img).transpose([2,0,1])
+        else:
+            out[b_i, r_i, :, :, :img.shape[1]] = new_img.transpose([2,0,1]).astype(np.float32) / 128.0 - 1.0
+
+    def take(self, n_repetitions, indices=None, device="cpu"):
+        """ Generate new repetitions
+
+        Args:
+            n_repetitions (int): repetitions per image
+            indices (list): batch items to generate repetitions for; None for all
+
+        Returns:
+            Tensor: len(indices), n_repetitions, channel, h, w
+        """
+        if indices is None:
+            indices = range(len(self.images))
+        dim0, dim1, dim2 = self.shape
+        out = padded_batch((len(indices), n_repetitions, dim2, dim0, dim1), uint8=self.uint8) # batch, repetitions, channel, h, w
+        jobs = [self.pool().submit(self._fill, out, b_i, r_i, self.images[i]) for b_i, i in enumerate(indices) for r_i in range(n_repetitions)]
+        for job in jobs:
+            job.result()
+
+        line_imgs = torch.from_numpy(out).to(device)
+        if self.transform is not None:
+            line_imgs = self.transform(line_imgs)
+        return line_imgs
+
+    def chunks(self, chunk_size, device="cpu"):
+        """ Yields all n_warp_iterations repetitions, chunk_size repetitions at a time
+        """
+        chunk_size = chunk_size or self.n_warp_iterations
+        for start in range(0, self.n_warp_iterations, chunk_size):
+            yield self.take(min(chunk_size, self.n_warp_iterations - start), device=device)
+
+def collate_repetition(batch, device="cpu", n_warp_iterations=21, warp=True, occlusion_freq=None, occlusion_size=None, occlusion_level=1,
+                       tta_chunk_size=None, tta_workers=4):
+    """ Collate with n_warp_iterations augmented repetitions of every image; uint8 items give a uint8 batch
+
+    Args:
+        tta_chunk_size (int): if set, repetitions are not generated here; "line_imgs" only holds the unaugmented images
+                              (batch, 1, channel, h, w) and "repetitions" generates them in chunks of this size on demand
+        tta_workers (int): threads for generating the repetitions on demand
+
+    """
     batch = [b for b in batch if b is not None]
     batch_size = len(batch)
     occlude = occlusion_size and occlusion_freq
@@ -87,28 +282,29 @@ def collate_repetition(batch, device="cpu", n_warp_iterations=21, warp=True, occ
 
     all_labels = []
     label_lengths = []
-    final = np.full((batch_size, n_warp_iterations, dim0, dim1, dim2), PADDING_CONSTANT).astype(np.float32)
+    repetitions = None
+    uint8 = batch[0]['line_img'].dtype == np.uint8
+    if tta_chunk_size:
+        # Keep only the source images; repetitions are generated as they are consumed
+        images = [x['line_img'] if uint8 else to_uint8((np.float32(x['line_img']) + 1) * 128.0) for x in batch]
+        repetitions = WarpRepetitions(images, (dim0, dim1, dim2), n_warp_iterations, warp=warp, occlusion_freq=occlusion_freq if occlude else None,
+                                      occlusion_size=occlusion_size, occlusion_level=occlusion_level, workers=tta_workers, uint8=uint8)
+        final = padded_batch((batch_size, 1, dim0, dim1, dim2), uint8=uint8)
+        for b_i, x in enumerate(batch):
+            final[b_i, 0, :, :x['line_img'].shape[1], :] = x['line_img']
+    else:
+        final = padded_batch((batch_size, n_warp_iterations, dim0, dim1, dim2), uint8=uint8)
 
     # Duplicate items in batch
     for b_i,x in enumerate(batch):
         # H, W, C
-        img = (np.float32(x['line_img']) + 1) * 128.0
+        img = x['line_img'] if uint8 else (np.float32(x['line_img']) + 1) * 128.0
 
         width = img.shape[1]
-        for r_i in range(n_warp_iterations):
-            new_img = img.copy()
-            if warp:
-                new_img = grid_distortion.warp_image(new_img)
-            if occlude:
-                new_img = grid_distortion.occlude(new_img, occlusion_freq=occlusion_freq, occlusion_size=occlusion_size, occlusion_level=occlusion_level)
-
-
-            # Add channel dimension, since resize and warp only keep non-trivial channel axis
-            if len(new_img.shape) == 2:
-                new_img = new_img[:, :, np.newaxis]
-
-            new_img = (new_img.astype(np.float32) / 128.0 - 1.0) # H, W, C
-            final[b_i, r_i, :, :width, :] = new_img
+        for r_i in range(0 if tta_chunk_size else n_warp_iterations):
+            new_img = augment_repetition(img, warp=warp, occlusion_freq=occlusion_freq if occlude else None,
+                                         occlusion_size=occlusion_size, occlusion_level=occlusion_level)
+            final[b_i, r_i, :, :width, :] = to_uint8(new_img) if uint8 else new_img.astype(np.float32) / 128.0 - 1.0 # H, W, C
 
         l = batch[b_i]['gt_label']
         all_labels.append(l)
@@ -130,7 +326,8 @@ def collate_repetition(batch, device="cpu", n_warp_iterations=21, warp=True, occ
         "gt": [b['gt'] for b in batch],
         "writer_id": torch.FloatTensor([b['writer_id'] for b in batch]),
         "paths": [b["path"] for b in batch],
-        "online": online
+        "online": online,
+        "repetitions": repetitions
     }
 
 
@@ -146,7 +343,14 @@ class HwDataset(Dataset):
                  occlusion_size=None,
                  occlusion_freq=None,
                  occlusion_level=1,
-                 logger=None):
+                 logger=None,
+                 packed_store=None,
+                 uint8=False):
+        """
+        Args:
+            uint8 (bool): return uint8 images in [0, 255] instead of float32 in [-1, 1]; batches stay uint8 through the
+                          collate and are normalized by the model's first layer (models.basic.InputNormalization)
+        """
 
         data = []
         for data_path in data_paths:
@@ -169,31 +373,48 @@ class HwDataset(Dataset):
         self.occlusion_size = occlusion_size
         self.occlusion_level = occlusion_level
         self.logger = logger
+        self.store = line_store.load_store(packed_store, img_height, num_of_channels) # None -> read images from disk
+        self.uint8 = uint8
+
+        # Ground truth encoded once: labels of item i are self.labels[self.label_offsets[i]:self.label_offsets[i+1]]
+        self.labels, self.label_offsets = string_utils.encode_all([d["gt"] for d in data], string_utils.char_lookup(char_to_idx))
 
     def __len__(self):
         return len(self.data)
 
+    def get_widths(self):
+        """ Width of every item after resizing to img_height, without decoding any images
+
+        Widths come from the packed store index if there is one, otherwise from the image file headers.
+
+        Returns:
+            np.array: widths in pixels; 0 for images that can't be read
+        """
+        widths = np.zeros(len(self.data), dtype=np.int64)
+        for i, item in enumerate(self.data):
+            image_path = os.path.join(self.root, item['image_path'])
+            if self.store is not None and image_path in self.store:
+                widths[i] = self.store.shape(image_path)[1]
+                continue
+            try:
+                with Image.open(image_path) as img:
+                    w, h = img.size # only reads the header
+                widths[i] = int(round(w * float(self.img_height) / h))
+            except Exception as e:
+                print("Warning: could not read image size:", image_path, e)
+        return widths
+
     def __getitem__(self, idx):
         item = self.data[idx]
 
         image_path = os.path.join(self.root, item['image_path'])
-        if self.num_of_channels == 3:
-            img = cv2.imread(image_path)
-        elif self.num_of_channels == 1: # read grayscale
-            img = cv2.imread(image_path, 0)
-        else:
-            raise Exception("Unexpected number of channels")
+        img = self.store.get(image_path) if self.store is not None else None
+        if img is None:
+            img = line_store.read_line_image(image_path, self.img_height, self.num_of_channels)
         if img is None:
             print("Warning: image is None:", os.path.join(self.root, item['image_path']))
             return None
 
-        percent = float(self.img_height) / img.shape[0]
-
-        #if random.randint(0, 1):
-        #    img = cv2.resize(img, (0,0), fx=percent, fy=percent, interpolation = cv2.INTER_CUBIC)
-        #else:
-        img = cv2.resize(img, (0, 0), fx=percent, fy=percent, interpolation=cv2.INTER_CUBIC)
-
         if self.warp:
             img = grid_distortion.warp_image(img)
 
@@ -206,12 +427,15 @@ class HwDataset(Dataset):
         if self.num_of_channels==1:
             img=img[:,:, np.newaxis]
 
-        img = img.astype(np.float32)
-        img = img / 128.0 - 1.0
+        if self.uint8:
+            img = to_uint8(img) # occlusion can make it float
+        else:
+            img = img.astype(np.float32)
+            img = img / 128.0 - 1.0
 
 
         gt = item['gt'] # actual text
-        gt_label = string_utils.str2label(gt, self.char_to_idx) # character indices of text
+        gt_label = self.labels[self.label_offsets[idx]:self.label_offsets[idx+1]] # character indices of text
         online = item["online"]
         
         return {
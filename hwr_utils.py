@@ -13,12 +13,15 @@ import yaml
 import json
 import os
 import datetime
-from Bio import pairwise2
 import numpy as np
 import warnings
 import string_utils
+import checkpoint
 import error_rates
+import metrics
 import glob
+import queue
+import threading
 from pathlib import Path
 
 def is_iterable(obj):
@@ -187,7 +190,60 @@ def load_config(config_path):
                 "occlusion_level": .4,
                 "exclude_offline": False,
                 "validation_jsons": [],
-                "elastic_transform": False
+                "elastic_transform": False,
+                "packed_store": None,
+                "width_bucketing": False,
+                "bucket_size": 50,
+                "batch_pixel_budget": None,
+                "max_batch_size": None,
+                "batch_augmentation": False,
+                "noise_level": None,
+                "augmentation_seed": None,
+                "tta_chunk_size": None,
+                "tta_workers": 4,
+                "tta_max_batch": None,
+                "tta_combine": "vote",
+                "tta_adaptive": False,
+                "tta_round_size": 3,
+                "tta_margin": 3,
+                "tta_confidence": None,
+                "decoder_type": "naive",
+                "beam_width": 30,
+                "beam_prune_threshold": -12.,
+                "beam_processes": 3,
+                "beam_lexicon": None,
+                "beam_n_best": 1,
+                "lm_path": None,
+                "lm_order": 5,
+                "lm_weight": .5,
+                "lm_insertion_bonus": 0.,
+                "training_cer_freq": 1,
+                "training_cer_samples": None,
+                "async_training_cer": False,
+                "ctc_on_device": False,
+                "prefetch_depth": 2,
+                "pin_memory": True,
+                "persistent_workers": False,
+                "multiprocessing_context": None,
+                "uint8_pipeline": False,
+                "step_timing": False,
+                "step_timing_sync": False,
+                "profile": False,
+                "profile_wait": 1,
+                "profile_warmup": 1,
+                "profile_active": 3,
+                "profile_repeat": 1,
+                "profile_record_shapes": True,
+                "profile_memory": True,
+                "profile_with_stack": False,
+                "num_workers": None,
+                "torch_threads": None,
+                "autotune": False,
+                "autotune_batches": 10,
+                "autotune_max_workers": 8,
+                "async_checkpoint": False,
+                "char_analysis": False,
+                "metrics_processes": 4
                 }
 
     for k in defaults.keys():
@@ -428,37 +484,36 @@ def write_out(folder, fname, text):
 
 class CharAcc:
     def __init__(self, char_to_idx):
-        self.correct = np.zeros(len(char_to_idx.keys()))
-        self.actual_counts = np.zeros(len(char_to_idx.keys()))
+        """ Per-character accuracy over many predictions; the last slot counts characters not in char_to_idx
+        """
+        self.char_to_idx = char_to_idx
+        self.correct = np.zeros(len(char_to_idx) + 1)
+        self.actual_counts = np.zeros(len(char_to_idx) + 1)
         self.false_positive = self.correct.copy() # thought letter was found, was not
         self.false_negative = self.correct.copy() # missed true classification
 
-        char_to_idx = char_to_idx.copy()
-        if min(char_to_idx.values())==1:
-            for key, val in char_to_idx.items():
-                char_to_idx[key] = val-1
+    def char_accuracy(self, pred, gt):
+        self.update([pred], [gt])
 
-        self.char_to_idx = char_to_idx
-        self.char_to_idx["|"] = self.char_to_idx["-"]
+    def update(self, preds, gts, processes=None):
+        """ Add the Levenshtein alignments of a batch (or a whole test set)
 
-    def char_accuracy(self, pred, gt):
-        pred = pred.replace("-", "|")
-        gt = gt.replace("-", "|")
-        pred_algn, gt_algn, *_ = pairwise2.align.globalxx(pred, gt)[0]
-
-        for i, c in enumerate(pred_algn):
-            guess_char=pred_algn[i]
-            true_char=gt_algn[i]
-            self.actual_counts[self.char_to_idx[true_char]] += 1
-            if guess_char == true_char:
-                self.correct[self.char_to_idx[c]] += 1
-            elif true_char == "-": # model inserted a letter incorrectly
-                self.false_positive[self.char_to_idx[guess_char]] += 1
-            elif guess_char == "-": # model missed letter
-                self.false_negative[self.char_to_idx[true_char]] += 1
-            elif guess_char != true_char: # model missed one letter, and incorrectly posited another
-                self.false_positive[self.char_to_idx[guess_char]] += 1
-                self.false_negative[self.char_to_idx[true_char]] += 1
+        Returns:
+            dict: the metrics.evaluate results of these lines
+        """
+        result = metrics.evaluate(preds, gts, self.char_to_idx, processes=processes)
+        correct, actual, false_positive, false_negative = result["char_counts"]
+        self.correct += correct
+        self.actual_counts += actual
+        self.false_positive += false_positive
+        self.false_negative += false_negative
+        return result
+
+    def accuracy(self):
+        """ Correct / actual for each character (nan if it never occurred)
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.correct / self.actual_counts
 
 def load_model(config):
     # User can specify folder or .pt file; other files are assumed to be in the same folder
@@ -519,6 +574,8 @@ def load_model(config):
             stats = json.load(fh)
 
         for name, stat in config["stats"].items():
+            if name not in stats: # stat added after the model was saved
+                continue
             if isinstance(stat, Stat):
                 config["stats"][name].y = stats[name]["y"]
             else:
@@ -546,6 +603,11 @@ def mkdir(path):
 
 
 def save_model(config, bsf=False):
+    """ Save the model, optimizer and stats to results_dir, or to results_dir/BSF and mirror that into results_dir
+
+        The files (and the visdom log) are written atomically by config["checkpoint_writer"]; with async_checkpoint
+        it runs in the background, so state dicts are snapshotted to CPU memory and the stats serialized here first.
+    """
     # Can pickle everything in config except items below
     # for x, y in config.items():
     #     print(x)
@@ -560,51 +622,62 @@ def save_model(config, bsf=False):
     else:
         path = config["results_dir"]
 
+    writer = config["checkpoint_writer"] if "checkpoint_writer" in config else checkpoint.CheckpointWriter(background=False)
+
     #    'model_definition': config["model"],
     state_dict = {
         'epoch': config["current_epoch"] + 1,
-        'model': config["model"].state_dict(),
-        'optimizer': config["optimizer"].state_dict(),
+        'model': writer.snapshot(config["model"].state_dict()),
+        'optimizer': writer.snapshot(config["optimizer"].state_dict()),
         'global_step': config["global_step"],
         "idx_to_char": config["idx_to_char"],
         "char_to_idx": config["char_to_idx"]
     }
 
     config["main_model_path"] = os.path.join(path, "{}_model.pt".format(config['name']))
-    torch.save(state_dict, config["main_model_path"])
+    models = {config["main_model_path"]: state_dict}
 
     if "nudger" in config.keys():
-        state_dict["model"] = config["nudger"].state_dict()
-        torch.save(state_dict, os.path.join(path, "{}_nudger_model.pt".format(config['name'])))
+        models[os.path.join(path, "{}_nudger_model.pt".format(config['name']))] = dict(state_dict, model=writer.snapshot(config["nudger"].state_dict()))
 
-    # Save all stats
-    results = config["stats"]
-    with open(os.path.join(path, "all_stats.json"), 'w') as fh:
-        json.dump(results, fh, cls=EnhancedJSONEncoder, indent=4)
-
-    # Save CER
+    # Stats keep changing during training, so they're serialized now
     #results = {"training":config["stats"][config["designated_training_cer"]], "test":config["stats"][config["designated_test_cer"]]}
-    results = {"train_cer":config["train_cer"], "test_cer":config["test_cer"]}
-    with open(os.path.join(path, "losses.json"), 'w') as fh:
-        json.dump(results, fh, cls=EnhancedJSONEncoder, indent=4)
+    texts = {os.path.join(path, "all_stats.json"): json.dumps(config["stats"], cls=EnhancedJSONEncoder, indent=4),
+             os.path.join(path, "losses.json"): json.dumps({"train_cer":config["train_cer"], "test_cer":config["test_cer"]}, cls=EnhancedJSONEncoder, indent=4)}
+
+    writer.submit(write_checkpoint, config, path, models, texts, bsf)
+
+    if config["save_count"]==0:
+        create_resume_training(config)
+    config["save_count"] += 1
+
+
+def write_checkpoint(config, path, models, texts, bsf=False):
+    """ Write the files of save_model and the visdom log to path, then (for BSF saves) link them into results_dir
+
+    Args:
+        path (str): results_dir or results_dir/BSF
+        models (dict): path -> state dict
+        texts (dict): path -> file contents
+        bsf (bool): mirror path into results_dir
+    """
+    for model_path, state_dict in models.items():
+        checkpoint.atomic_save(state_dict, model_path)
+    for text_path, text in texts.items():
+        checkpoint.atomic_write_text(text, text_path)
 
     # Save visdom
     if config["use_visdom"]:
+        visdom_path = os.path.join(path, "visdom.json")
         try:
-            path = os.path.join(path, "visdom.json")
-            config["visdom_manager"].save_env(file_path=path)
+            config["visdom_manager"].save_env(file_path=visdom_path)
         except:
-            warnings.warn(f"Unable to save visdom to {path}; is it started?")
+            warnings.warn(f"Unable to save visdom to {visdom_path}; is it started?")
             config["use_visdom"] = False
 
-    # Copy BSF stuff to main directory
+    # Link BSF stuff into main directory
     if bsf:
-        for filename in glob.glob(path + r"/*"):
-            shutil.copy(filename, config["results_dir"])
-
-    if config["save_count"]==0:
-        create_resume_training(config)
-    config["save_count"] += 1
+        checkpoint.mirror(path, config["results_dir"])
 
 
 def create_resume_training(config):
@@ -652,29 +725,71 @@ def plt_loss(config):
 
 
 class Decoder:
-    def __init__(self, idx_to_char, beam=False):
+    def __init__(self, idx_to_char, beam=False, beam_width=30, beam_processes=3, prefix_beam=None):
+        """ Greedy decoding for training; greedy, ctcdecode beam or built-in prefix beam decoding for testing
+
+        Args:
+            idx_to_char (dict):
+            beam (bool): use the ctcdecode package for testing
+            beam_width (int): ctcdecode beam width
+            beam_processes (int): ctcdecode processes
+            prefix_beam (ctc_decoder.BeamSearchDecoder): use the built-in prefix beam search for testing
+        """
         self.decode_training = self.decode_batch_naive
         self.decode_test = self.decode_batch_naive
         self.idx_to_char = idx_to_char
+        # Index -> character lookup table for vectorized decoding
+        self.char_table = string_utils.char_array(idx_to_char)
 
         if beam:
             from ctcdecode import CTCBeamDecoder
             print("Using beam")
-            self.beam_decoder = CTCBeamDecoder(labels=idx_to_char.values(), blank_id=0, beam_width=30, num_processes=3, log_probs_input=True)
+            self.beam_decoder = CTCBeamDecoder(labels=idx_to_char.values(), blank_id=0, beam_width=beam_width, num_processes=beam_processes, log_probs_input=True)
             self.decode_test = self.decode_batch_beam
+        elif prefix_beam is not None:
+            self.prefix_beam = prefix_beam
+            self.decode_test = self.decode_batch_prefix_beam
+
+    def greedy_labels(self, out):
+        """ Best path decoding of a whole batch at once: argmax, collapse repeats, drop blanks
+
+        Args:
+            out (Tensor): batch, width, vocab; runs on whichever device holds it
+
+        Returns:
+            list: an int array of labels for each batch item
+        """
+        best = out.detach().argmax(dim=2) # batch, width
+        keep = best != 0
+        keep[:, 1:] &= best[:, 1:] != best[:, :-1]
+        lengths = keep.sum(dim=1).cpu().numpy()
+        labels = best[keep].cpu().numpy()
+        return np.split(labels, np.cumsum(lengths)[:-1])
+
+    def labels_to_strings(self, labels):
+        return ["".join(self.char_table[label]) for label in labels]
+
+    def decode_batch_greedy(self, out):
+        """ Greedy decoding returning both forms
+
+        Args:
+            out (Tensor): batch, width, vocab
+
+        Returns:
+            tuple: list of label arrays, list of strings
+        """
+        labels = self.greedy_labels(out)
+        return labels, self.labels_to_strings(labels)
 
     def decode_batch_naive(self, out, as_string=True):
-        out = out.data.cpu().numpy()
-        for j in range(out.shape[0]):
-            logits = out[j, ...]
-            pred, raw_pred = string_utils.naive_decode(logits)
-            if as_string:
-                yield string_utils.label2str(pred, self.idx_to_char, False)
-            else:
-                yield pred
+        labels = self.greedy_labels(out)
+        if as_string:
+            yield from self.labels_to_strings(labels)
+        else:
+            yield from labels
 
     def decode_batch_beam(self, out, as_string=True):
-        pred, scores, timesteps, out_seq_len = self.beam_decoder.decode(out)
+        pred, scores, timesteps, out_seq_len = self.beam_decoder.decode(out.cpu())
         pred = pred.data.int().numpy()
         output_lengths = out_seq_len.data.data.numpy()
         rank = 0 # get top ranked prediction
@@ -690,16 +805,128 @@ class Decoder:
             else:
                 yield line
 
+    def prefix_beam_labels(self, out):
+        log_probs = torch.nn.functional.log_softmax(out.detach(), dim=2).cpu().numpy()
+        return self.prefix_beam.decode(log_probs)
+
+    def decode_n_best(self, out):
+        """ Prefix beam search n-best lists
+
+        Args:
+            out (Tensor): batch, width, vocab logits
+
+        Returns:
+            list: for each line, a list of (string, log score) pairs, best first
+        """
+        return [[(self.labels_to_strings([np.array(label, dtype=int)])[0], score) for label, score in n_best]
+                for n_best in self.prefix_beam_labels(out)]
+
+    def decode_batch_prefix_beam(self, out, as_string=True):
+        for n_best in self.prefix_beam_labels(out):
+            label = np.array(n_best[0][0], dtype=int)
+            yield self.labels_to_strings([label])[0] if as_string else label
+
 def calculate_cer(pred_strs, gt):
-    sum_loss = 0
-    steps = 0
-    for j, pred_str in enumerate(pred_strs):
-        gt_str = gt[j]
-        cer = error_rates.cer(gt_str, pred_str)
-        sum_loss += cer
-        steps += 1
-    return sum_loss, steps
+    """ Sum of per-line CERs and number of lines
+    """
+    return metrics.cer_sum(pred_strs, gt)
+
 
+class TrainingCer:
+    def __init__(self, decoder, stats, stat_name="Training Error Rate", freq=1, samples=None, background=False,
+                 queue_size=8, seed=None, timer=None):
+        """ Training CER estimated on every freq-th step, on at most `samples` lines of the batch
+
+        With background=True, decoding and edit distances run in a thread fed by a bounded queue; if the queue
+        is full the snapshot is dropped rather than making the training step wait. Call flush() before
+        reading the stat.
+
+        Args:
+            decoder (Decoder):
+            stats (dict): config["stats"]
+            stat_name (str): Stat accumulating the CER
+            freq (int): score every freq-th step
+            samples (int): lines scored per step; None for the whole batch
+            background (bool): score in a background thread
+            queue_size (int): snapshots waiting to be scored
+            seed (int): seed for choosing the sampled lines
+            timer (timing.StepTimer): times the "decode" and "cer" stages
+        """
+        self.decoder = decoder
+        self.stats = stats
+        self.stat_name = stat_name
+        self.freq = max(1, freq or 1)
+        self.samples = samples
+        self.background = background
+        self.random_state = np.random.RandomState(seed)
+        self.timer = timer
+        self.dropped = 0 # snapshots dropped because the queue was full
+        self.error = None # first exception raised while scoring in the background
+        self.lock = threading.Lock()
+        if background:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def __call__(self, output_batch, gt, step):
+        """ Score (or queue) a batch
+
+        Args:
+            output_batch (Tensor): batch, width, vocab
+            gt (list): ground truth strings
+            step (int): global step; None scores the whole batch right away, ignoring freq/samples/background
+
+        Returns:
+            tuple: CER sum, predicted strings; both None unless the whole batch was scored right away
+        """
+        if step is None: # e.g. improve_image, which reads the CER and predictions of every iteration
+            return self._score(output_batch, gt)
+        if step % self.freq:
+            return None, None
+        whole_batch = not self.samples or self.samples >= len(gt)
+        if not whole_batch:
+            idx = np.sort(self.random_state.choice(len(gt), self.samples, replace=False))
+            output_batch, gt = output_batch[torch.from_numpy(idx).to(output_batch.device)], [gt[i] for i in idx]
+        if self.background:
+            try:
+                self.queue.put_nowait((output_batch.detach(), gt))
+            except queue.Full:
+                self.dropped += 1
+            return None, None
+        err, pred_strs = self._score(output_batch, gt)
+        return (err, pred_strs) if whole_batch else (None, None)
+
+    def _score(self, output_batch, gt):
+        if self.timer is None:
+            pred_strs = list(self.decoder.decode_training(output_batch))
+            err, weight = calculate_cer(pred_strs, gt)
+        else:
+            with self.timer("decode"):
+                pred_strs = list(self.decoder.decode_training(output_batch))
+            with self.timer("cer"):
+                err, weight = calculate_cer(pred_strs, gt)
+        with self.lock:
+            self.stats[self.stat_name].accumulate(err, weight)
+        return err, pred_strs
+
+    def _run(self):
+        while True:
+            output_batch, gt = self.queue.get()
+            try:
+                self._score(output_batch, gt)
+            except Exception as e: # keep scoring later snapshots; flush() re-raises on the training thread
+                self.error = self.error or e
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """ Wait until every queued snapshot has been scored; raises the first error of the background thread
+        """
+        if self.background:
+            self.queue.join()
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
 
 def accumulate_stats(config, freq=None):
     for title, stat in config["stats"].items():
@@ -799,6 +1026,10 @@ def stat_prep(config):
     config_stats.append(Stat(y=[], x=config["stats"]["epoch_decimal"], x_title="Epochs", y_title="CER", name="Training Error Rate"))
     config_stats.append(Stat(y=[], x=[], x_title="Epochs", y_title="CER", name="Test Error Rate", ymax=.2))
     config_stats.append(Stat(y=[], x=config["stats"]["epochs"], x_title="Epochs", y_title="CER", name="Validation Error Rate", ymax=.2))
+    config_stats.append(Stat(y=[], x=config["stats"]["updates"], x_title="Updates", y_title="Padding Ratio", name="Training Padding Ratio", ymax=1))
+    if config["tta_adaptive"]:
+        config_stats.append(Stat(y=[], x=config["stats"]["epochs"], x_title="Epochs", y_title="Warps", name="Test TTA Warps"))
+        config_stats.append(Stat(y=[], x=config["stats"]["epochs"], x_title="Epochs", y_title="Warps", name="Validation TTA Warps"))
     config["designated_training_cer"] = "Training Error Rate"
     config["designated_test_cer"] = "Test Error Rate"
     config["designated_validation_cer"] = "Validation Error Rate"
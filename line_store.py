@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import warnings
+
+import cv2
+import numpy as np
+
+## Packed line-image store
+# All line images for one (input_height, num_of_channels) pair are resized once and written back-to-back
+# as raw uint8 into a single .bin file; a JSON index maps each image path to its (offset, shape).
+# Workers then memory-map the .bin file, so images are served as array slices with no decoding,
+# and the OS page cache is shared between all DataLoader workers.
+
+def read_line_image(image_path, img_height, num_of_channels):
+    """ Load an image from disk and resize it to img_height, preserving aspect ratio
+
+    Args:
+        image_path (str): path to the image
+        img_height (int): height in pixels of the resized image
+        num_of_channels (int): 1 for grayscale, 3 for BGR
+
+    Returns:
+        np.array: uint8 array, H x W (grayscale) or H x W x 3, or None if the image can't be read
+    """
+    if num_of_channels == 3:
+        img = cv2.imread(image_path)
+    elif num_of_channels == 1: # read grayscale
+        img = cv2.imread(image_path, 0)
+    else:
+        raise Exception("Unexpected number of channels")
+    if img is None:
+        return None
+
+    percent = float(img_height) / img.shape[0]
+    img = cv2.resize(img, (0, 0), fx=percent, fy=percent, interpolation=cv2.INTER_CUBIC)
+    return img
+
+def store_paths(store_dir, img_height, num_of_channels):
+    """ A store is specific to the image height and number of channels it was packed with
+
+    Returns:
+        tuple: path to the .bin data file, path to the .json index
+    """
+    base = os.path.join(store_dir, "lines_h{}_c{}".format(img_height, num_of_channels))
+    return base + ".bin", base + ".json"
+
+def pack_images(data_paths, store_dir, img_height=32, num_of_channels=3, root="./data", overwrite=False):
+    """ Resize every image referenced by the JSON manifests and append it to the packed store
+
+    Images already in the store are skipped, so training, testing and validation manifests
+    can be packed into the same store one after another.
+
+    Args:
+        data_paths (list): JSON manifests, relative to root
+        store_dir (str): folder for the .bin and .json files
+        img_height (int):
+        num_of_channels (int):
+        root (str): data root the manifests/images are relative to
+        overwrite (bool): start a new store instead of appending
+
+    Returns:
+        int: number of images added
+    """
+    bin_path, index_path = store_paths(store_dir, img_height, num_of_channels)
+    store_exists = os.path.exists(index_path) and os.path.exists(bin_path)
+    os.makedirs(store_dir, exist_ok=True)
+
+    if store_exists and not overwrite:
+        with open(index_path) as f:
+            index = json.load(f)
+    else:
+        index = {"img_height": img_height, "num_of_channels": num_of_channels, "items": {}}
+        open(bin_path, "wb").close()
+
+    items = index["items"]
+    added = 0
+    with open(bin_path, "ab") as f:
+        offset = f.tell()
+        for data_path in data_paths:
+            with open(os.path.join(root, data_path)) as fp:
+                data = json.load(fp)
+
+            for item in data:
+                image_path = os.path.join(root, item['image_path'])
+                if image_path in items:
+                    continue
+                img = read_line_image(image_path, img_height, num_of_channels)
+                if img is None:
+                    print("Warning: image is None:", image_path)
+                    continue
+                img = np.ascontiguousarray(img, dtype=np.uint8)
+                f.write(img.tobytes())
+                items[image_path] = [offset, list(img.shape)]
+                offset += img.nbytes
+                added += 1
+
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+    return added
+
+class PackedLineStore:
+    """ Read-only view of a packed store; the .bin file is memory-mapped lazily in each process
+    """
+    def __init__(self, store_dir, img_height=32, num_of_channels=3):
+        self.bin_path, self.index_path = store_paths(store_dir, img_height, num_of_channels)
+        with open(self.index_path) as f:
+            index = json.load(f)
+        self.items = index["items"]
+        self._data = None
+
+    def __contains__(self, image_path):
+        return image_path in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getstate__(self):
+        # Don't send the memory map to worker processes; each worker maps the file itself
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.bin_path, dtype=np.uint8, mode="r")
+        return self._data
+
+    def shape(self, image_path):
+        return tuple(self.items[image_path][1])
+
+    def get(self, image_path):
+        """ Returns a read-only uint8 view into the store, or None if the image was not packed
+        """
+        if image_path not in self.items:
+            return None
+        offset, shape = self.items[image_path]
+        size = int(np.prod(shape))
+        return self.data[offset:offset+size].reshape(shape)
+
+def load_store(store_dir, img_height, num_of_channels):
+    """ Returns a PackedLineStore, or None (with a warning) if the store hasn't been packed yet
+    """
+    if not store_dir:
+        return None
+    bin_path, index_path = store_paths(store_dir, img_height, num_of_channels)
+    if not (os.path.exists(bin_path) and os.path.exists(index_path)):
+        warnings.warn(f"Packed store not found at {bin_path}; run `python line_store.py CONFIG` to create it")
+        return None
+    return PackedLineStore(store_dir, img_height, num_of_channels)
+
+def main(config_path):
+    """ Pack the training, testing and validation images of a config into its packed_store folder
+    """
+    from hwr_utils import read_config, find_config
+    config = read_config(find_config(config_path))
+    store_dir = config.get("packed_store") or os.path.join(config["training_root"], "packed")
+    jobs = [(config["training_jsons"], config["training_root"]),
+            (config["testing_jsons"], config["testing_root"]),
+            (config.get("validation_jsons", []), config["testing_root"])]
+    for data_paths, root in jobs:
+        added = pack_images(data_paths, store_dir, img_height=config["input_height"],
+                            num_of_channels=config["num_of_channels"], root=root)
+        print(f"Packed {added} images from {data_paths} into {store_dir}")
+
+if __name__ == "__main__":
+    main(sys.argv[1])
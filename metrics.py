@@ -0,0 +1,170 @@
+from multiprocessing import Pool
+
+import editdistance
+import numpy as np
+
+## Error rates and alignments for whole batches / test sets
+# Edit distances use the C editdistance package; alignments use a NumPy Levenshtein matrix (one vectorized
+# update per row) and a backtrace. Per-character counts are accumulated with np.bincount, and large
+# evaluation sets are split over a process pool.
+
+GAP = -1
+
+def normalize(text):
+    """ Collapse repeated/leading/trailing whitespace, like error_rates.cer
+    """
+    return u" ".join(text.split())
+
+def error_rate(distance, length):
+    """ Same convention as error_rates.err: an empty reference counts every hypothesis character as an error
+    """
+    return float(distance) if length == 0 else float(distance) / length
+
+def levenshtein_matrix(a, b):
+    """ Full edit-distance matrix between two label sequences
+
+    Each row is computed at once: the insertion chain along the row is a running minimum of
+    (candidate - j), then + j.
+
+    Args:
+        a, b (np.array): int sequences
+
+    Returns:
+        np.array: (len(a)+1) x (len(b)+1) distances
+    """
+    a, b = np.asarray(a), np.asarray(b)
+    m = len(b)
+    j = np.arange(m + 1)
+    d = np.empty((len(a) + 1, m + 1), dtype=np.int32)
+    d[0] = j
+    for i in range(1, len(a) + 1):
+        prev = d[i - 1]
+        candidate = np.empty(m + 1, dtype=np.int32)
+        candidate[0] = i
+        candidate[1:] = np.minimum(prev[1:] + 1, prev[:-1] + (b != a[i - 1])) # deletion, substitution/match
+        d[i] = np.minimum.accumulate(candidate - j) + j # insertion
+    return d
+
+def align(pred, gt):
+    """ Levenshtein alignment by backtrace
+
+    Args:
+        pred, gt (np.array): int sequences
+
+    Returns:
+        tuple: aligned pred and gt arrays of equal length, with GAP where one side has no character
+    """
+    pred, gt = np.asarray(pred), np.asarray(gt)
+    d = levenshtein_matrix(pred, gt)
+    i, j = len(pred), len(gt)
+    pred_aligned, gt_aligned = [], []
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and d[i, j] == d[i - 1, j - 1] + (pred[i - 1] != gt[j - 1]):
+            pred_aligned.append(pred[i - 1]); gt_aligned.append(gt[j - 1]); i -= 1; j -= 1
+        elif i > 0 and d[i, j] == d[i - 1, j] + 1: # inserted by the model
+            pred_aligned.append(pred[i - 1]); gt_aligned.append(GAP); i -= 1
+        else: # missed by the model
+            pred_aligned.append(GAP); gt_aligned.append(gt[j - 1]); j -= 1
+    return np.array(pred_aligned[::-1], dtype=np.int64), np.array(gt_aligned[::-1], dtype=np.int64)
+
+def encode(text, char_to_idx):
+    """ Label array of a string; characters missing from char_to_idx are mapped to len(char_to_idx)
+    """
+    unknown = len(char_to_idx)
+    return np.array([char_to_idx.get(c, unknown) for c in text], dtype=np.int64)
+
+def character_counts(pred_labels, gt_labels, n_chars):
+    """ Per-character counts from the alignment of one line
+
+    Returns:
+        np.array: 4 x n_chars: correct, actual (in gt), false positive (posited, not there), false negative (missed)
+    """
+    pred_aligned, gt_aligned = align(pred_labels, gt_labels)
+    match = pred_aligned == gt_aligned
+    posited, present = pred_aligned != GAP, gt_aligned != GAP
+    counts = np.zeros((4, n_chars), dtype=np.int64)
+    counts[0] = np.bincount(gt_aligned[match], minlength=n_chars)[:n_chars]
+    counts[1] = np.bincount(gt_aligned[present], minlength=n_chars)[:n_chars]
+    counts[2] = np.bincount(pred_aligned[posited & ~match], minlength=n_chars)[:n_chars]
+    counts[3] = np.bincount(gt_aligned[present & ~match], minlength=n_chars)[:n_chars]
+    return counts
+
+def evaluate_lines(preds, gts, char_to_idx=None):
+    """ Error statistics of a list of lines
+
+    Args:
+        preds (list): predicted strings
+        gts (list): ground truth strings
+        char_to_idx (dict): if given, also count per-character correct/actual/false positive/false negative
+
+    Returns:
+        dict: sums over the lines; see evaluate
+    """
+    result = {"lines": 0, "cer_sum": 0., "wer_sum": 0., "char_edits": 0, "chars": 0, "word_edits": 0, "words": 0}
+    n_chars = len(char_to_idx) + 1 if char_to_idx else 0 # last slot: characters outside char_to_idx
+    if char_to_idx:
+        result["char_counts"] = np.zeros((4, n_chars), dtype=np.int64)
+    for pred, gt in zip(preds, gts):
+        pred, gt = normalize(pred), normalize(gt)
+        char_edits = editdistance.eval(gt, pred)
+        pred_words, gt_words = pred.split(), gt.split()
+        word_edits = editdistance.eval(gt_words, pred_words)
+        result["lines"] += 1
+        result["cer_sum"] += error_rate(char_edits, len(gt))
+        result["wer_sum"] += error_rate(word_edits, len(gt_words))
+        result["char_edits"] += char_edits
+        result["chars"] += len(gt)
+        result["word_edits"] += word_edits
+        result["words"] += len(gt_words)
+        if char_to_idx:
+            result["char_counts"] += character_counts(encode(pred, char_to_idx), encode(gt, char_to_idx), n_chars)
+    return result
+
+def _evaluate_chunk(args):
+    return evaluate_lines(*args)
+
+def _merge(results):
+    total = results[0]
+    for result in results[1:]:
+        for key, value in result.items():
+            total[key] = total[key] + value
+    return total
+
+def evaluate(preds, gts, char_to_idx=None, processes=None, chunk_size=500):
+    """ Error statistics of a whole evaluation set, split over a process pool when it is large
+
+    Args:
+        preds (list): predicted strings
+        gts (list): ground truth strings
+        char_to_idx (dict): if given, also return per-character counts
+        processes (int): worker processes; None or 1 evaluates in this process
+        chunk_size (int): lines per task
+
+    Returns:
+        dict: "cer"/"wer" (mean per-line rates, like calculate_cer), "micro_cer"/"micro_wer" (total edits / total
+              length), "lines", "cer_sum", "wer_sum", "char_edits", "chars", "word_edits", "words", and with
+              char_to_idx "char_counts" (4 x len(char_to_idx)+1: correct, actual, false positive, false negative)
+    """
+    preds, gts = list(preds), list(gts)
+    if processes and processes > 1 and len(preds) > chunk_size:
+        chunks = [(preds[i:i+chunk_size], gts[i:i+chunk_size], char_to_idx) for i in range(0, len(preds), chunk_size)]
+        with Pool(processes) as pool:
+            result = _merge(pool.map(_evaluate_chunk, chunks))
+    else:
+        result = evaluate_lines(preds, gts, char_to_idx)
+    lines = max(1, result["lines"])
+    result["cer"] = result["cer_sum"] / lines
+    result["wer"] = result["wer_sum"] / lines
+    result["micro_cer"] = result["char_edits"] / max(1, result["chars"])
+    result["micro_wer"] = result["word_edits"] / max(1, result["words"])
+    return result
+
+def cer_sum(preds, gts):
+    """ Sum of per-line CERs and number of lines, as used by the CER stats
+    """
+    total, lines = 0., 0
+    for pred, gt in zip(preds, gts):
+        gt = normalize(gt)
+        total += error_rate(editdistance.eval(gt, normalize(pred)), len(gt))
+        lines += 1
+    return total, lines
@@ -3,7 +3,7 @@ from torch import nn
 from hwr_utils import *
 import os
 from torch.autograd import Variable
-from models.basic import BidirectionalRNN, GeneralizedBRNN, PrintLayer
+from models.basic import BidirectionalRNN, GeneralizedBRNN, PrintLayer, InputNormalization
 
 class CRCR(nn.Module):
     def __init__(self, cnnOutSize=1024, nc=3, leakyRelu=False, type="default"):
@@ -18,6 +18,7 @@ class CRCR(nn.Module):
         """
         super().__init__()
         self.cnnOutSize = cnnOutSize
+        self.normalize = InputNormalization()
         self.cnn = self.default_CRCR(nc=nc, leakyRelu=leakyRelu)
         print("Creating a CNN with Recurrent layer")
 
@@ -76,5 +77,5 @@ class CRCR(nn.Module):
         return output
 
     def forward(self, input):
-        x = self.post_process(self.cnn(input))
+        x = self.post_process(self.cnn(self.normalize(input)))
         return x
\ No newline at end of file
@@ -121,6 +121,19 @@ class PrintLayer(nn.Module):
         print(x.size(), self.name)
         return x
 
+def normalize_input(line_imgs):
+    """ uint8 pixels in [0, 255] -> float in [-1, 1]; float images are assumed to be normalized already
+    """
+    if line_imgs.dtype == torch.uint8:
+        return line_imgs.float() / 128.0 - 1.0
+    return line_imgs
+
+class InputNormalization(nn.Module):
+    """ First layer of the CNNs, so batches can stay uint8 until they reach the device (see uint8_pipeline)
+    """
+    def forward(self, x):
+        return normalize_input(x)
+
 class CNN(nn.Module):
     def __init__(self, cnnOutSize=1024, nc=3, leakyRelu=False, type="default"):
         """ Height must be set to be consistent; width is variable, longer images are fed into BLSTM in longer sequences
@@ -134,6 +147,7 @@ class CNN(nn.Module):
         """
         super().__init__()
         self.cnnOutSize = cnnOutSize
+        self.normalize = InputNormalization()
         #self.average_pool = nn.AdaptiveAvgPool2d((512,2))
         self.pool = nn.MaxPool2d(3, (4, 1), padding=1)
         self.intermediate_pass = 13 if type == "intermediates" else None
@@ -232,6 +246,7 @@ class CNN(nn.Module):
 
     def forward(self, input):
         # INPUT: BATCH, CHANNELS (1 or 3), Height, Width
+        input = self.normalize(input)
         if self.intermediate_pass is None:
             x = self.post_process(self.cnn(input))
             #assert self.cnnOutSize == x.shape[1] * x.shape[2]
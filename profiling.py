@@ -0,0 +1,144 @@
+import os
+import logging
+
+import torch
+from torch import nn
+
+## torch.profiler capture of a window of steps
+# StepProfiler is started at the beginning of a run (training, test_only or improve_image); the loops call step()
+# after every batch, the wait/warmup/active schedule decides which steps are recorded, and the profiler stops
+# itself once the schedule is over, so the rest of the run isn't slowed down. Each finished window is written to
+# results_dir as a Chrome trace (chrome://tracing, Perfetto) plus operator, memory and input-shape tables.
+# Custom modules (CNN, CRCR, GeneralizedBRNN, ...) and RNNs are wrapped in record_function scopes, so their
+# share of the time shows up as "module: <name>" rows instead of being spread over anonymous aten ops.
+# torch.profiler (torch >= 1.8) is only imported once a StepProfiler is created, so importing this module (and
+# train.py) works on older torch versions as long as profile is off.
+
+def _labelled_modules(model):
+    for name, module in model.named_modules():
+        if not name:
+            continue
+        if isinstance(module, nn.RNNBase) or not type(module).__module__.startswith("torch."):
+            yield name, module
+
+class StepProfiler:
+    enabled = True
+
+    def __init__(self, output_dir, name="train", model=None, wait=1, warmup=1, active=3, repeat=1,
+                 record_shapes=True, profile_memory=True, with_stack=False, row_limit=40, logger=None):
+        """
+        Args:
+            output_dir (str): where traces and tables are written
+            name (str): prefix of the output files, e.g. train / test / improve
+            model (nn.Module): if given, its custom modules and RNNs get record_function scopes while profiling
+            wait, warmup, active, repeat (int): torch.profiler.schedule; steps skipped, traced but discarded, and recorded
+            record_shapes (bool): record operator input shapes
+            profile_memory (bool): record tensor allocations
+            with_stack (bool): record Python stacks (large traces)
+            row_limit (int): rows per summary table
+            logger (logging.Logger):
+        """
+        self.output_dir = output_dir
+        self.name = name
+        self.model = model
+        self.row_limit = row_limit
+        self.logger = logger or logging.getLogger(__name__)
+        from torch.profiler import profile, schedule, ProfilerActivity
+        self.cuda = torch.cuda.is_available()
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if self.cuda else [])
+        self.profiler = profile(activities=activities,
+                                schedule=schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+                                on_trace_ready=self._on_trace_ready, record_shapes=record_shapes,
+                                profile_memory=profile_memory, with_stack=with_stack)
+        self.hooks = []
+        self.steps_left = (wait + warmup + active) * repeat if repeat else None
+        self.running = False
+
+    def _add_module_scopes(self):
+        from torch.profiler import record_function
+        for name, module in _labelled_modules(self.model):
+            label = f"module: {name} ({type(module).__name__})"
+            def pre_hook(module, input, label=label):
+                scope = record_function(label)
+                scope.__enter__()
+                module._profiler_scopes = getattr(module, "_profiler_scopes", []) + [scope]
+            def post_hook(module, input, output):
+                module._profiler_scopes.pop().__exit__(None, None, None)
+            self.hooks.append(module.register_forward_pre_hook(pre_hook))
+            self.hooks.append(module.register_forward_hook(post_hook))
+
+    def _on_trace_ready(self, prof):
+        prefix = os.path.join(self.output_dir, f"profile_{self.name}_{prof.step_num}")
+        prof.export_chrome_trace(prefix + ".json")
+        sort_by = "self_cuda_time_total" if self.cuda else "self_cpu_time_total"
+        tables = [("Operators by self time", prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)),
+                  ("Operators by total time (module scopes)", prof.key_averages().table(sort_by=sort_by.replace("self_", ""), row_limit=self.row_limit)),
+                  ("Operators by allocated memory", prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=self.row_limit)),
+                  ("Operators by input shape", prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=self.row_limit))]
+        with open(prefix + ".txt", "w") as f:
+            for title, table in tables:
+                f.write(f"{title}\n{table}\n\n")
+        self.logger.info(f"Profiler trace written to {prefix}.json, tables to {prefix}.txt")
+
+    def start(self):
+        if self.model is not None:
+            self._add_module_scopes()
+        self.profiler.start()
+        self.running = True
+
+    def stop(self):
+        """ Stop profiling; a partially recorded window is still written out
+        """
+        if not self.running:
+            return
+        self.profiler.stop()
+        self.running = False
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def step(self):
+        if not self.running:
+            return
+        self.profiler.step()
+        if self.steps_left is not None:
+            self.steps_left -= 1
+            if self.steps_left <= 0:
+                self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+class NullProfiler:
+    """ Disabled StepProfiler
+    """
+    enabled = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def step(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def from_config(config, name="train"):
+    """ StepProfiler if profile is on, else NullProfiler
+    """
+    if not config["profile"]:
+        return NullProfiler()
+    return StepProfiler(config["results_dir"], name=name, model=config["model"], wait=config["profile_wait"],
+                        warmup=config["profile_warmup"], active=config["profile_active"], repeat=config["profile_repeat"],
+                        record_shapes=config["profile_record_shapes"], profile_memory=config["profile_memory"],
+                        with_stack=config["profile_with_stack"], logger=config["logger"])
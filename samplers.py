@@ -0,0 +1,114 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+## Batch samplers
+# Lines vary severalfold in width, and collate_basic pads every image to the widest one in its batch.
+# Grouping lines of similar width into the same batch keeps most of the CNN/LSTM compute off the padding.
+
+def padding_ratio(widths):
+    """ Fraction of a padded batch that is padding
+
+    Args:
+        widths (list): widths of the images in one batch
+
+    Returns:
+        float: 0 means no padding
+    """
+    widths = np.asarray(widths)
+    if widths.size == 0:
+        return 0.
+    return 1 - widths.sum() / (widths.size * widths.max())
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, widths, batch_size, bucket_size=50, shuffle=True, drop_last=False, seed=None):
+        """ Yields batches of dataset indices whose images have similar widths
+
+        Indices are (optionally) shuffled, split into buckets of batch_size * bucket_size items,
+        sorted by width within each bucket and cut into batches; the batches are then shuffled
+        so consecutive batches still come from different parts of the dataset.
+
+        Args:
+            widths (list): width of every item in the dataset after resizing
+            batch_size (int): items per batch
+            bucket_size (int): number of batches per bucket; larger buckets -> less padding, less randomness
+            shuffle (bool): shuffle the dataset and the batch order every epoch
+            drop_last (bool): drop the last (smaller) batch of each bucket
+            seed (int): seed for the shuffling
+        """
+        self.widths = np.asarray(widths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.random_state = np.random.RandomState(seed)
+        self.padding_ratios = [] # padding ratio of each batch of the last epoch
+        self._pending = None # batches drawn by __len__ for the next epoch
+
+    def _buckets(self):
+        indices = self.random_state.permutation(len(self.widths)) if self.shuffle else np.arange(len(self.widths))
+        bucket_length = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), bucket_length):
+            bucket = indices[start:start+bucket_length]
+            yield bucket[np.argsort(self.widths[bucket], kind="stable")]
+
+    def _make_batches(self, bucket):
+        batches = [bucket[i:i+self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def batches(self):
+        batches = []
+        for bucket in self._buckets():
+            batches.extend(self._make_batches(bucket))
+        if self.shuffle:
+            batches = [batches[i] for i in self.random_state.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self._pending if self._pending is not None else self.batches()
+        self._pending = None
+        self.padding_ratios = [padding_ratio(self.widths[b]) for b in batches]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        # Batch count can depend on the shuffle (e.g. with a pixel budget), so draw the next epoch's batches now
+        if self._pending is None:
+            self._pending = self.batches()
+        return len(self._pending)
+
+class PixelBudgetBatchSampler(BucketBatchSampler):
+    def __init__(self, widths, max_pixels, img_height, batch_size=None, bucket_items=1000, shuffle=True, seed=None):
+        """ Fills each batch up to a maximum padded pixel area instead of a fixed number of items
+
+        Batches of short lines get many items, batches of long lines few, so memory use and step time
+        stay roughly constant. A single line larger than the budget still gets its own batch.
+
+        Args:
+            widths (list): width of every item in the dataset after resizing
+            max_pixels (int): maximum of items * widest item * img_height per batch
+            img_height (int): height of every image
+            batch_size (int): optional cap on the number of items per batch
+            bucket_items (int): number of items per bucket
+            shuffle (bool): shuffle the dataset and the batch order every epoch
+            seed (int): seed for the shuffling
+        """
+        super().__init__(widths, batch_size=bucket_items, bucket_size=1, shuffle=shuffle, drop_last=False, seed=seed)
+        self.max_pixels = max_pixels
+        self.img_height = img_height
+        self.max_items = batch_size
+
+    def _make_batches(self, bucket):
+        batches = []
+        start = 0
+        # Bucket is sorted by width, so the newest item is always the widest in its batch
+        for i in range(len(bucket)):
+            n = i - start + 1
+            too_many = self.max_items and n > self.max_items
+            if n > 1 and (too_many or n * self.widths[bucket[i]] * self.img_height > self.max_pixels):
+                batches.append(bucket[start:i])
+                start = i
+        if start < len(bucket):
+            batches.append(bucket[start:])
+        return batches
@@ -1,5 +1,78 @@
 import numpy as np
 
+## Array-based encoding
+# char_lookup maps code points straight to labels (an array indexed by ord), so whole strings, or all the ground truth
+# of a dataset at once, are encoded with one NumPy gather instead of a dict lookup per character. char_array is the
+# reverse table (label -> character) used to decode label arrays with a single fancy index and join.
+
+UNKNOWN = -1
+
+def char_lookup(char_to_idx):
+    """ Array indexed by code point giving the label of each character of char_to_idx, UNKNOWN for the rest
+    """
+    chars = [c for c in char_to_idx if len(c) == 1]
+    lookup = np.full(max([ord(c) for c in chars], default=0) + 1, UNKNOWN, dtype=np.int64)
+    for c in chars:
+        lookup[ord(c)] = char_to_idx[c]
+    return lookup
+
+def char_array(idx_to_char):
+    """ Object array of the character of each label; labels missing from idx_to_char decode to ""
+    """
+    return np.array([idx_to_char.get(i, "") for i in range(max(idx_to_char) + 1)], dtype=object)
+
+def _code_points(text):
+    return np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+
+def encode(text, lookup):
+    """ Vectorized str2label: characters that aren't in the lookup are dropped
+
+    Args:
+        text (str):
+        lookup (np.array): from char_lookup
+
+    Returns:
+        np.array: uint32 labels
+    """
+    return encode_all([text], lookup)[0]
+
+def encode_all(texts, lookup):
+    """ Encode many strings at once into one concatenated label array
+
+    Args:
+        texts (list): strings
+        lookup (np.array): from char_lookup
+
+    Returns:
+        tuple: uint32 labels of all texts, int64 offsets (len(texts)+1); labels of text i are labels[offsets[i]:offsets[i+1]]
+    """
+    texts = list(texts)
+    codes = _code_points("".join(texts))
+    text_ids = np.repeat(np.arange(len(texts)), [len(t) for t in texts])
+    labels = np.full(len(codes), UNKNOWN, dtype=np.int64)
+    known = codes < len(lookup)
+    labels[known] = lookup[codes[known]]
+    kept = labels != UNKNOWN
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(text_ids[kept], minlength=len(texts)), out=offsets[1:])
+    return labels[kept].astype(np.uint32), offsets
+
+def decode(label, chars, as_raw=False, space_char="|"):
+    """ Vectorized label2str
+
+    Args:
+        label (np.array): labels
+        chars (np.array): from char_array
+        as_raw (bool): write blanks (0) as space_char instead of stopping at the first one
+    """
+    label = np.asarray(label, dtype=np.int64)
+    if as_raw:
+        return "".join(np.where(label == 0, space_char, chars[label]))
+    blanks = np.flatnonzero(label == 0)
+    if len(blanks):
+        label = label[:blanks[0]]
+    return "".join(chars[label])
+
 def str2label(value, characterToIndex={}, unknown_index=None):
     if unknown_index is None:
         unknown_index = len(characterToIndex)
@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+
+import pytest
+import torch
+
+import checkpoint
+import hwr_utils
+
+class FakeVisdom:
+    """ Stands in for the Visdom client: get_window_data returns one text window whose content changes each call
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def get_window_data(self):
+        self.calls += 1
+        return json.dumps({"win": {"id": "win", "type": "text", "content": f"save {self.calls}", "height": None, "width": None}})
+
+def make_config(results_dir, background, visdom_manager=None):
+    model = torch.nn.Sequential(torch.nn.Linear(3, 2), torch.nn.BatchNorm1d(2))
+    return {"results_dir": results_dir, "name": "test", "current_epoch": 0, "global_step": 0, "model": model,
+            "optimizer": torch.optim.Adam(model.parameters()), "idx_to_char": {0: "|"}, "char_to_idx": {"|": 0},
+            "stats": {}, "train_cer": [], "test_cer": [], "save_count": 1, "logger": logging.getLogger(__name__),
+            "use_visdom": visdom_manager is not None, "visdom_manager": visdom_manager,
+            "checkpoint_writer": checkpoint.CheckpointWriter(background=background)}
+
+@pytest.mark.parametrize("background", [False, True])
+def test_normal_save_keeps_bsf(tmp_path, background):
+    """ A BSF save followed by a normal save leaves the BSF model untouched
+    """
+    config = make_config(str(tmp_path), background)
+    hwr_utils.save_model(config, bsf=True)
+    with torch.no_grad():
+        config["model"][0].weight += 1
+    hwr_utils.save_model(config, bsf=False)
+    config["checkpoint_writer"].close()
+
+    bsf = torch.load(tmp_path / "BSF" / "test_model.pt")["model"]["0.weight"]
+    latest = torch.load(tmp_path / "test_model.pt")["model"]["0.weight"]
+    assert torch.allclose(bsf + 1, latest)
+
+@pytest.mark.parametrize("background", [False, True])
+def test_normal_save_keeps_bsf_visdom(tmp_path, background):
+    """ The visdom log mirrored from BSF isn't rewritten by the next normal save
+    """
+    visualize = pytest.importorskip("visualize")
+    plot = visualize.Plot.__new__(visualize.Plot)
+    plot.viz, plot.env_name, plot.config = FakeVisdom(), "test", None
+    config = make_config(str(tmp_path), background, plot)
+
+    hwr_utils.save_model(config, bsf=True)
+    config["checkpoint_writer"].wait()
+    bsf_visdom = (tmp_path / "BSF" / "visdom.json").read_text()
+    assert (tmp_path / "visdom.json").read_text() == bsf_visdom
+
+    hwr_utils.save_model(config, bsf=False)
+    config["checkpoint_writer"].close()
+    assert (tmp_path / "BSF" / "visdom.json").read_text() == bsf_visdom
+    assert (tmp_path / "visdom.json").read_text() != bsf_visdom
@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+import hwr_utils
+
+def failing_decoder(idx_to_char):
+    """ Decoder whose first decode_training call raises
+    """
+    decoder = hwr_utils.Decoder(idx_to_char)
+    decode, calls = decoder.decode_training, []
+    def decode_training(output_batch):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError("decode failed")
+        return decode(output_batch)
+    decoder.decode_training = decode_training
+    return decoder
+
+def test_background_error_keeps_worker_alive():
+    """ An error while scoring in the background is raised by flush(), and later snapshots are still scored
+    """
+    stats = {"Training Error Rate": hwr_utils.Stat(y=[], x=[], name="Training Error Rate")}
+    training_cer = hwr_utils.TrainingCer(failing_decoder({0: "|", 1: "a", 2: "b"}), stats, background=True)
+    output_batch = torch.randn(2, 10, 3)
+
+    training_cer(output_batch, ["ab", "ba"], 0)
+    with pytest.raises(ValueError):
+        training_cer.flush()
+
+    training_cer(output_batch, ["ab", "ba"], 1)
+    training_cer.flush() # returns: the worker is still running
+    assert stats["Training Error Rate"].current_weight > 0
@@ -0,0 +1,36 @@
+import logging
+
+import pytest
+import torch
+
+import crnn
+import hwr_utils
+
+def make_trainer(**tta):
+    torch.manual_seed(0)
+    idx_to_char = {0: "|", 1: "a", 2: "b", 3: " ", 4: "c"}
+    config = {"cnn_out_size": 1024, "num_of_channels": 1, "alphabet_size": 5, "rnn_dimension": 16,
+              "recognizer_dropout": .5, "rnn_type": "lstm", "style_encoder": "2Stage"}
+    model = crnn.create_2Stage(config)
+    config.update({"idx_to_char": idx_to_char, "decoder": hwr_utils.Decoder(idx_to_char),
+                   "stats": {"Validation TTA Warps": hwr_utils.Stat(y=[], x=[], name="Validation TTA Warps")},
+                   "logger": logging.getLogger(__name__), "training_cer_freq": 1, "training_cer_samples": None,
+                   "async_training_cer": False, "n_warp_iterations": 3, "ctc_on_device": False, "tta_chunk_size": None,
+                   "tta_max_batch": None, "tta_combine": "vote", "tta_adaptive": False, "tta_round_size": 1,
+                   "tta_margin": 1, "tta_confidence": None})
+    config.update(tta)
+    return crnn.TrainerBaseline(model, None, config, None)
+
+@pytest.mark.parametrize("tta", [{}, {"tta_combine": "mean"}, {"tta_max_batch": 2}, {"tta_adaptive": True}])
+def test_nudger_input_is_batch_sized(tta):
+    """ test_warp(nudger=True) returns the rnn_input of the first repetition, not of the folded batch
+    """
+    trainer = make_trainer(**tta)
+    batch_size = 2
+    line_imgs = torch.randint(0, 256, (batch_size, 3, 1, 60, 120), dtype=torch.uint8)
+    online = torch.zeros(1, batch_size, 1)
+    with torch.no_grad():
+        rnn_input = trainer.test(line_imgs, online, ["ab", "c"], nudger=True)
+        expected = trainer.forward(line_imgs[:, 0], online)[1]
+    assert rnn_input.shape == expected.shape
+    assert torch.allclose(rnn_input, expected, atol=1e-5)
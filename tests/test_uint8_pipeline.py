@@ -0,0 +1,30 @@
+import logging
+
+import torch
+
+import crnn
+import hwr_utils
+
+def make_trainer(model):
+    idx_to_char = {0: "|", 1: "a", 2: "b", 3: " ", 4: "c"}
+    config = {"idx_to_char": idx_to_char, "decoder": hwr_utils.Decoder(idx_to_char), "stats": {}, "logger": logging.getLogger(__name__),
+              "training_cer_freq": 1, "training_cer_samples": None, "async_training_cer": False, "n_warp_iterations": 0,
+              "ctc_on_device": False}
+    return crnn.TrainerBaseline(model, None, config, None)
+
+def test_non_basic_model_uint8_batch():
+    """ A model other than basic_CRNN gets the same output from a uint8 batch as from the normalized float batch
+    """
+    torch.manual_seed(0)
+    config = {"cnn_out_size": 1024, "num_of_channels": 1, "alphabet_size": 5, "rnn_dimension": 16,
+              "recognizer_dropout": .5, "rnn_type": "lstm", "style_encoder": "2Stage"}
+    model = crnn.create_2Stage(config).eval()
+    trainer = make_trainer(model)
+    line_imgs = torch.randint(0, 256, (2, 1, 60, 120), dtype=torch.uint8)
+    online = torch.zeros(1, 2, 1)
+
+    with torch.no_grad():
+        from_uint8 = trainer.forward(line_imgs, online)[0]
+        from_float = model(line_imgs.float() / 128.0 - 1.0, online)[0]
+    assert from_uint8.dtype == torch.float32
+    assert torch.allclose(from_uint8, from_float)
@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import torch
+
+from hwr_utils import Stat
+
+## Per-stage wall-clock timing of the training loop
+# StepTimer times named stages of every step (`with timer("forward"): ...`) into TimingStats, which are
+# aggregated with the other stats by accumulate_stats: y gets the mean of each window, `percentiles` its
+# quantiles. NullTimer has the same interface and does nothing, so the loop is instrumented unconditionally.
+# CUDA work is asynchronous; without sync=True a stage's time shows up wherever the next synchronization happens.
+
+STAGES = ("data", "to_device", "augment", "forward", "loss", "backward", "step", "decode", "cer", "plot")
+_NULL_CONTEXT = nullcontext()
+
+class TimingStat(Stat):
+    def __init__(self, x, name, percentiles=(50, 90, 99)):
+        """ Stat of durations in seconds
+
+        Args:
+            x (list): shared x-axis values (e.g. config["stats"]["updates"])
+            percentiles (tuple): percentiles kept for each window, in `percentiles["p50"]` etc.
+        """
+        super().__init__(y=[], x=x, x_title="Updates", y_title="Seconds", name=name)
+        self.quantiles = list(percentiles)
+        self.percentiles = {f"p{p}": [] for p in percentiles}
+        self.samples = []
+
+    def accumulate(self, sum, weight=1, step=None):
+        self.samples.append(sum)
+        super().accumulate(sum, weight, step)
+
+    def reset_accumlator(self):
+        if self.accumlator_active:
+            for p, value in zip(self.quantiles, np.percentile(self.samples, self.quantiles)):
+                self.percentiles[f"p{p}"].append(float(value))
+            self.samples = []
+        super().reset_accumlator()
+
+class StepTimer:
+    enabled = True
+
+    def __init__(self, stats, x, stages=STAGES, percentiles=(50, 90, 99), sync=False, visdom_manager=None, prefix="Time"):
+        """
+        Args:
+            stats (dict): config["stats"]; a TimingStat named "{prefix} {stage}" is added for each stage
+            x (list): x-axis values of the stats
+            stages (tuple): stage names
+            sync (bool): synchronize CUDA before and after each stage so time is charged to the stage that queued the work
+            visdom_manager (visualize.Plot): if given, the stats are registered for plotting
+        """
+        self.stats = stats
+        self.names = {}
+        self.sync = sync and torch.cuda.is_available()
+        self.lock = threading.Lock() # TrainingCer can time decoding from its background thread
+        for stage in stages:
+            self.names[stage] = f"{prefix} {stage}"
+            stats[self.names[stage]] = TimingStat(x, self.names[stage], percentiles=percentiles)
+            if visdom_manager is not None:
+                visdom_manager.register_plot(self.names[stage], "Updates", "Seconds")
+
+    @contextmanager
+    def __call__(self, stage):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.stats[self.names[stage]].accumulate(seconds, 1)
+
+    def iterate(self, iterable):
+        """ Iterate over a DataLoader, timing each wait for the next batch as the "data" stage
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record("data", time.perf_counter() - start)
+            yield item
+
+    def summary(self):
+        """ Latest window of each stage: {stage: {"mean": ..., "p50": ..., ...}} in seconds
+        """
+        result = {}
+        for stage, name in self.names.items():
+            stat = self.stats[name]
+            if stat.y:
+                result[stage] = {"mean": stat.y[-1], **{p: values[-1] for p, values in stat.percentiles.items()}}
+        return result
+
+    def export(self, path):
+        """ Write every window of every stage to path/timing.json
+        """
+        result = {stage: {"updates": list(self.stats[name].x[-len(self.stats[name].y):]) if self.stats[name].y else [],
+                          "mean": self.stats[name].y, **self.stats[name].percentiles}
+                  for stage, name in self.names.items()}
+        with open(os.path.join(path, "timing.json"), "w") as f:
+            json.dump(result, f, indent=2)
+
+class NullTimer:
+    """ Disabled StepTimer
+    """
+    enabled = False
+
+    def __call__(self, stage):
+        return _NULL_CONTEXT
+
+    def record(self, stage, seconds):
+        pass
+
+    def iterate(self, iterable):
+        return iterable
+
+    def summary(self):
+        return {}
+
+    def export(self, path):
+        pass
+
+def from_config(config):
+    """ StepTimer if step_timing is on, else NullTimer; call after stat_prep
+    """
+    if not config["step_timing"]:
+        return NullTimer()
+    return StepTimer(config["stats"], config["stats"]["updates"], sync=config["step_timing_sync"],
+                     visdom_manager=config["visdom_manager"] if config["use_visdom"] else None)
@@ -30,6 +30,11 @@ import types
 # Dropout schedule
 
 import error_rates
+import ctc_decoder
+import timing
+import profiling
+import autotune
+import checkpoint
 import string_utils
 from torch.nn import CrossEntropyLoss
 import traceback
@@ -43,6 +48,9 @@ import time
 from hwr_utils import *
 from torch.optim import lr_scheduler
 from crnn import Stat
+from samplers import BucketBatchSampler, PixelBudgetBatchSampler
+from batch_augment import BatchAugmenter
+from models.basic import normalize_input
 
 ## Notes on usage
 # conda activate hw2
@@ -50,24 +58,29 @@ from crnn import Stat
 
 
 faulthandler.enable()
-#torch.set_num_threads(torch.get_num_threads())
-#print(torch.get_num_threads())
-
-threads = max(1, min(torch.get_num_threads()-2,6))
-print(f"Threads: {threads}")
-#threads = 1
-torch.set_num_threads(threads)
 
 def test(model, dataloader, idx_to_char, device, config, with_analysis=False, plot_all=False, validation=True):
     sum_loss = 0.0
     steps = 0.0
     model.eval()
+    analysis = with_analysis or config["char_analysis"]
+    all_preds, all_gts = [], []
 
     for i,x in enumerate(dataloader):
         line_imgs = x['line_imgs'].to(device)
+        repetitions = x.get("repetitions") # generated on demand by the trainer if tta_chunk_size is set
+        if config["test_batch_augmenter"] and config["n_warp_iterations"]:
+            if repetitions is None:
+                line_imgs = config["test_batch_augmenter"].repetitions(line_imgs)
+            else:
+                repetitions.transform = config["test_batch_augmenter"].repetitions
         gt = x['gt']  # actual string ground truth
         online = x['online'].view(1, -1, 1).to(device)
-        loss, initial_err, pred_str = config["trainer"].test(line_imgs, online, gt, validation=validation)
+        loss, initial_err, pred_str = config["trainer"].test(line_imgs, online, gt, validation=validation, repetitions=repetitions)
+        config["profiler"].step()
+        if analysis:
+            all_preds.extend(pred_str)
+            all_gts.extend(gt)
 
         if plot_all:
             imgs = x["line_imgs"][:, 0, :, :, :] if config["n_warp_iterations"] else x['line_imgs']
@@ -81,6 +94,11 @@ def test(model, dataloader, idx_to_char, device, config, with_analysis=False, pl
 
     stat = "validation" if validation else "test"
     cer = config["stats"][config[f"designated_{stat}_cer"]].y[-1]  # most recent test CER
+    if config["tta_adaptive"] and config["n_warp_iterations"]:
+        warps = config["stats"][f"{stat.capitalize()} TTA Warps"].y[-1]
+        LOGGER.info(f"Adaptive TTA: {warps:.2f} warps per line on average (max {config['n_warp_iterations']})")
+    if analysis:
+        char_analysis(all_preds, all_gts, config, f"{stat}_{config['current_epoch']}")
 
     if not plot_all:
         imgs = x["line_imgs"][:, 0, :, :, :] if config["n_warp_iterations"] else x['line_imgs']
@@ -89,8 +107,28 @@ def test(model, dataloader, idx_to_char, device, config, with_analysis=False, pl
     LOGGER.debug(config["stats"])
     return cer
 
+def char_analysis(preds, gts, config, name):
+    """ Word error rate and per-character accuracy of a whole test set, saved to results_dir/char_analysis_{name}.json
+    """
+    char_acc = CharAcc(config["char_to_idx"])
+    result = char_acc.update(preds, gts, processes=config["metrics_processes"])
+    LOGGER.info(f"{name}: WER {result['wer']:.4f}, CER {result['cer']:.4f} (micro: WER {result['micro_wer']:.4f}, CER {result['micro_cer']:.4f})")
+
+    idx_to_char = {idx: char for char, idx in config["char_to_idx"].items()}
+    idx_to_char[len(config["char_to_idx"])] = "<unknown>"
+    accuracy = char_acc.accuracy()
+    chars = {idx_to_char[i]: {"correct": int(char_acc.correct[i]), "actual": int(char_acc.actual_counts[i]),
+                              "false_positive": int(char_acc.false_positive[i]),
+                              "false_negative": int(char_acc.false_negative[i]),
+                              "accuracy": None if np.isnan(accuracy[i]) else float(accuracy[i])}
+             for i in range(len(accuracy)) if i in idx_to_char}
+    summary = {k: result[k] for k in ["cer", "wer", "micro_cer", "micro_wer", "lines", "chars", "words"]}
+    with open(os.path.join(config["results_dir"], f"char_analysis_{name}.json"), "w") as f:
+        json.dump({"summary": summary, "characters": chars}, f, indent=2)
+    return result
+
 def to_numpy(tensor):
-    if isinstance(tensor,torch.FloatTensor) or isinstance(tensor,torch.cuda.FloatTensor):
+    if isinstance(tensor, torch.Tensor):
         return tensor.detach().cpu().numpy()
     else:
         return tensor
@@ -113,6 +151,8 @@ def plot_images(line_imgs, name, text_str, dir=None, plot_count=None):
 
     if isinstance(text_str, types.GeneratorType):
         text_str = list(text_str)
+    elif text_str is None: # e.g. training CER not computed for this batch
+        text_str = [""] * batch_size
 
     if len(line_imgs) > 1:
 
@@ -161,7 +201,7 @@ def improver(model, dataloader, ctc_criterion, optimizer, dtype, config, iterati
 
     for i, x in enumerate(dataloader):
         LOGGER.debug("Improving Iteration: {}".format(i))
-        line_imgs = x['line_imgs'].type(dtype).clone().detach().requires_grad_(True)
+        line_imgs = normalize_input(x['line_imgs'].to(config["device"])).type(dtype).clone().detach().requires_grad_(True)
         params = [torch.nn.Parameter(line_imgs)]
         config["trainer"].optimizer = torch.optim.SGD(params, lr=lr, momentum=0)
 
@@ -174,12 +214,14 @@ def improver(model, dataloader, ctc_criterion, optimizer, dtype, config, iterati
         online = tensor(online_vector.type(dtype), requires_grad=False).view(1, -1, 1) 
 
         loss, initial_err, first_pred_str = config["trainer"].train(params[0], online, labels, label_lengths, gt,
-                                                                    step=config["global_step"])
+                                                                    step=None) # score every iteration
         # Nudge it X times
         for j in range(iterations):
             loss, final_err, final_pred_str = config["trainer"].train(params[0], online, labels, label_lengths, gt,
-                                                                      step=config["global_step"])
+                                                                      step=None)
+            config["profiler"].step()
             # print(torch.abs(x['line_imgs']-params[0]).sum())
+            config["trainer"].flush_stats()
             accumulate_stats(config)
             training_cer = config["stats"][config["designated_training_cer"]].y[-1]  # most recent training CER
             if j % 5 == 0:
@@ -196,85 +238,157 @@ def run_epoch(model, dataloader, ctc_criterion, optimizer, dtype, config):
     model.train()
     config["stats"]["epochs"] += [config["current_epoch"]]
     plot_freq = config["plot_freq"]
+    epoch_instances = 0
+    timer = config["timer"]
 
-    for i, x in enumerate(dataloader):
+    for i, x in enumerate(timer.iterate(dataloader)):
         LOGGER.debug(f"Training Iteration: {i}")
-        line_imgs = Variable(x['line_imgs'].type(dtype), requires_grad=False)
+        with timer("to_device"):
+            line_imgs = x['line_imgs']
+            # uint8 batches (uint8_pipeline) are normalized by the model
+            line_imgs = Variable(line_imgs.to(config["device"]) if line_imgs.dtype == torch.uint8 else line_imgs.type(dtype), requires_grad=False)
+        if config["batch_augmenter"]:
+            with timer("augment"):
+                line_imgs = config["batch_augmenter"](line_imgs)
         labels = Variable(x['labels'], requires_grad=False)  # numeric indices version of ground truth
         label_lengths = Variable(x['label_lengths'], requires_grad=False)
         gt = x['gt']  # actual string ground truth
         config["global_step"] += 1
         config["global_instances_counter"] += line_imgs.shape[0]
+        epoch_instances += line_imgs.shape[0]
         config["stats"]["instances"] += [config["global_instances_counter"]]
 
         # Add online/offline binary flag
         online = Variable(x['online'].type(dtype), requires_grad=False).view(1, -1, 1)
 
         loss, initial_err, first_pred_str = config["trainer"].train(line_imgs, online, labels, label_lengths, gt, step=config["global_step"])
+        config["profiler"].step()
+        config["stats"]["Training Padding Ratio"].accumulate(x["padding_ratio"], 1)
 
-        LOGGER.debug("Finished with batch")
+        LOGGER.debug(f"Finished with batch, padding ratio: {x['padding_ratio']:.3f}")
 
         # Update visdom every 50 instances
         if (config["global_step"] % plot_freq == 0 and config["global_step"] > 0) or config["TESTING"] or config["SMALL_TRAINING"]:
             config["stats"]["updates"] += [config["global_step"]]
             config["stats"]["epoch_decimal"] += [
-                config["current_epoch"] + i * config["batch_size"] * 1.0 / config['n_train_instances']]
+                config["current_epoch"] + epoch_instances * 1.0 / config['n_train_instances']]
             LOGGER.info(f"updates: {config['global_step']}")
-            accumulate_stats(config)
-            visualize.plot_all(config)
+            with timer("plot"):
+                config["trainer"].flush_stats()
+                accumulate_stats(config)
+                visualize.plot_all(config)
 
         if config["TESTING"] or config["SMALL_TRAINING"]:
             break
 
-    training_cer_list = config["stats"][config["designated_training_cer"]].y
-
-    if not training_cer_list:
+    # Record what was scored since the last plot update, including snapshots still queued for async_training_cer
+    config["trainer"].flush_stats()
+    training_cer_stat = config["stats"][config["designated_training_cer"]]
+    if training_cer_stat.accumlator_active or not training_cer_stat.y:
+        config["stats"]["updates"] += [config["global_step"]]
+        config["stats"]["epoch_decimal"] += [
+            config["current_epoch"] + epoch_instances * 1.0 / config['n_train_instances']]
         accumulate_stats(config)
+    training_cer_list = training_cer_stat.y
 
-    training_cer = training_cer_list[-1]  # most recent training CER
+    training_cer = training_cer_list[-1] if training_cer_list else None  # most recent training CER (None if never sampled)
     LOGGER.debug(config["stats"])
 
     # Save images
-    plot_images(x['line_imgs'], f"{config['current_epoch']}_training", first_pred_str, dir=config["image_train_dir"])
+    with timer("plot"):
+        plot_images(x['line_imgs'], f"{config['current_epoch']}_training", first_pred_str, dir=config["image_train_dir"])
+
+    if timer.enabled:
+        LOGGER.info("Step timing (mean/p90 ms): " + ", ".join(f"{stage} {t['mean']*1000:.1f}/{t['p90']*1000:.1f}"
+                                                             for stage, t in timer.summary().items()))
+        timer.export(config["results_dir"])
 
     return training_cer
 
 
+def make_batch_sampler(dataset, config, shuffle, repetitions=1):
+    """ Use a batch sampler that groups lines of similar width if width_bucketing is on, or that fills
+        batches up to batch_pixel_budget if one is set
+
+    Args:
+        repetitions (int): each item is repeated this many times in the batch (test-time warping); the
+                           pixel budget is divided by it
+
+    Returns:
+        dict: keyword arguments for the DataLoader
+    """
+    if config["batch_pixel_budget"]:
+        batch_sampler = PixelBudgetBatchSampler(dataset.get_widths(), config["batch_pixel_budget"] / max(1, repetitions),
+                                                img_height=config["input_height"], batch_size=config["max_batch_size"],
+                                                bucket_items=config["batch_size"] * config["bucket_size"], shuffle=shuffle)
+        return {"batch_sampler": batch_sampler}
+    elif not config["width_bucketing"]:
+        return {"batch_size": config["batch_size"], "shuffle": shuffle}
+    batch_sampler = BucketBatchSampler(dataset.get_widths(), config["batch_size"], bucket_size=config["bucket_size"], shuffle=shuffle)
+    return {"batch_sampler": batch_sampler}
+
+def worker_kwargs(config, device, persistent=True):
+    """ DataLoader worker settings: pinned batches when training on a GPU, optional persistent workers and
+        multiprocessing start method (collate functions are picklable, so "spawn" works)
+    """
+    kwargs = {"num_workers": config["num_workers"], "pin_memory": bool(config["pin_memory"]) and torch.device(device).type == "cuda"}
+    if config["num_workers"] > 0:
+        kwargs["persistent_workers"] = bool(config["persistent_workers"]) and persistent
+        if config["multiprocessing_context"]:
+            kwargs["multiprocessing_context"] = config["multiprocessing_context"]
+    return kwargs
+
+def prefetch(dataloader, config, device):
+    """ Stage batches onto the GPU ahead of time if prefetch_depth is set
+    """
+    if not config["prefetch_depth"] or torch.device(device).type != "cuda":
+        return dataloader
+    keys = ("line_imgs", "online", "labels") if config["ctc_on_device"] else ("line_imgs", "online")
+    return hw_dataset.DevicePrefetcher(dataloader, device, depth=config["prefetch_depth"], keys=keys)
+
 def make_dataloaders(config, device="cpu"):
+    # With batch augmentation, warping/occlusion happen on whole batches in run_epoch/test instead of in the workers
+    augment_items = not config["batch_augmentation"]
     train_dataset = HwDataset(config["training_jsons"],
                               config["char_to_idx"],
                               img_height=config["input_height"],
                               num_of_channels=config["num_of_channels"],
                               root=config["training_root"],
-                              warp=config["training_warp"],
+                              warp=config["training_warp"] and augment_items,
                               images_to_load=config["images_to_load"],
-                              occlusion_size=config["occlusion_size"],
-                              occlusion_freq=config["occlusion_freq"],
+                              occlusion_size=config["occlusion_size"] if augment_items else None,
+                              occlusion_freq=config["occlusion_freq"] if augment_items else None,
                               occlusion_level=config["occlusion_level"],
-                              logger=config["logger"])
+                              logger=config["logger"],
+                              packed_store=config["packed_store"],
+                              uint8=config["uint8_pipeline"])
 
     train_dataloader = DataLoader(train_dataset,
-                                  batch_size=config["batch_size"],
-                                  shuffle=config["training_shuffle"],
-                                  num_workers=threads,
-                                  collate_fn=lambda x:hw_dataset.collate(x,device=device),
-                                  pin_memory=device=="cpu")
+                                  **make_batch_sampler(train_dataset, config, shuffle=config["training_shuffle"]),
+                                  collate_fn=hw_dataset.Collate(),
+                                  **worker_kwargs(config, device))
 
     # Handle basic vs with warp iterations
-    if config["testing_occlude"]:
-        collate_fn = lambda x: hw_dataset.collate(x,
-                                                  device=device,
-                                                  n_warp_iterations=config['n_warp_iterations'],
-                                                  warp=config["testing_warp"],
-                                                  occlusion_freq=config["occlusion_freq"],
-                                                  occlusion_size=config["occlusion_size"],
-                                                  occlusion_level=config["occlusion_level"],
-                                                  use_occlusion=config["testing_occlude"])
+    if config["batch_augmentation"]:
+        # Only duplicate the images; repetitions are augmented as one batch in test()
+        collate_fn = hw_dataset.Collate(n_warp_iterations=config['n_warp_iterations'],
+                                        warp=False, occlusion_freq=None, occlusion_size=None,
+                                        occlusion_level=None, tta_chunk_size=config["tta_chunk_size"],
+                                        tta_workers=config["tta_workers"])
+    elif config["testing_occlude"]:
+        collate_fn = hw_dataset.Collate(n_warp_iterations=config['n_warp_iterations'],
+                                        warp=config["testing_warp"],
+                                        occlusion_freq=config["occlusion_freq"],
+                                        occlusion_size=config["occlusion_size"],
+                                        occlusion_level=config["occlusion_level"],
+                                        tta_chunk_size=config["tta_chunk_size"],
+                                        tta_workers=config["tta_workers"])
     else:
-        collate_fn = lambda x: hw_dataset.collate(x, device=device, n_warp_iterations=config['n_warp_iterations'],
-                                                  warp=config["testing_warp"], occlusion_freq=None,
-                                                  occlusion_size=None,
-                                                  occlusion_level=None)
+        collate_fn = hw_dataset.Collate(n_warp_iterations=config['n_warp_iterations'],
+                                        warp=config["testing_warp"], occlusion_freq=None,
+                                        occlusion_size=None,
+                                        occlusion_level=None, tta_chunk_size=config["tta_chunk_size"],
+                                        tta_workers=config["tta_workers"])
 
     test_dataset = HwDataset(config["testing_jsons"],
                              config["char_to_idx"],
@@ -283,34 +397,43 @@ def make_dataloaders(config, device="cpu"):
                              root=config["testing_root"],
                              warp=False,
                              images_to_load=config["images_to_load"],
-                             logger=config["logger"])
+                             logger=config["logger"],
+                             packed_store=config["packed_store"],
+                             uint8=config["uint8_pipeline"])
 
+    # Not persistent: final_test changes the collate settings
     test_dataloader = DataLoader(test_dataset,
-                                 batch_size=config["batch_size"],
-                                 shuffle=config["testing_shuffle"],
-                                 num_workers=threads,
-                                 collate_fn=collate_fn)
+                                 **make_batch_sampler(test_dataset, config, shuffle=config["testing_shuffle"], repetitions=config["n_warp_iterations"]),
+                                 collate_fn=collate_fn,
+                                 **worker_kwargs(config, device, persistent=False))
 
     if "validation_jsons" in config:
         validation_dataset = HwDataset(config["validation_jsons"], config["char_to_idx"], img_height=config["input_height"],
                                  num_of_channels=config["num_of_channels"], root=config["testing_root"],
-                                 warp=False, images_to_load=config["images_to_load"], logger=config["logger"])
+                                 warp=False, images_to_load=config["images_to_load"], logger=config["logger"],
+                                 packed_store=config["packed_store"], uint8=config["uint8_pipeline"])
 
-        validation_dataloader = DataLoader(validation_dataset, batch_size=config["batch_size"], shuffle=config["testing_shuffle"],
-                                     num_workers=threads, collate_fn=lambda x:hw_dataset.collate(x,device=device))
+        validation_dataloader = DataLoader(validation_dataset, **make_batch_sampler(validation_dataset, config, shuffle=config["testing_shuffle"]),
+                                           collate_fn=hw_dataset.Collate(), **worker_kwargs(config, device))
+        validation_dataloader = prefetch(validation_dataloader, config, device)
     else:
-        validation_dataset, validation_dataloader = test_dataset, test_dataloader
+        validation_dataset, validation_dataloader = test_dataset, None
         config["validation_jsons"]=None
 
+    train_dataloader = prefetch(train_dataloader, config, device)
+    test_dataloader = prefetch(test_dataloader, config, device)
+    if validation_dataloader is None:
+        validation_dataloader = test_dataloader
+
     return train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader
 
 
-def load_data(config):
+def load_data(config, device="cpu"):
     # Load characters and prep datasets
     config["char_to_idx"], config["idx_to_char"], config["char_freq"] = character_set.make_char_set(
         config['training_jsons'], root=config["training_root"])
 
-    train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader = make_dataloaders(config=config)
+    train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader = make_dataloaders(config=config, device=device)
 
     config['alphabet_size'] = len(config["idx_to_char"])   # alphabet size to be recognized
     config['num_of_writers'] = train_dataset.classes_count + 1
@@ -320,6 +443,25 @@ def load_data(config):
     log_print("Number of test instances:", len(test_dataloader.dataset), '\n')
     return train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader
 
+def set_threads(config):
+    """ Resolve num_workers/torch_threads (None: cores - 2, capped at 6) and set the intra-op threads
+    """
+    threads = max(1, min(torch.get_num_threads()-2, 6))
+    for key in ("num_workers", "torch_threads"):
+        if config[key] is None:
+            config[key] = threads
+    torch.set_num_threads(config["torch_threads"])
+    LOGGER.info(f"Threads: {config['torch_threads']}, DataLoader workers: {config['num_workers']}")
+
+def tune_workers(config, train_dataset, device):
+    """ Pick num_workers, torch_threads and prefetch_depth by timing the data pipeline against the training step
+    """
+    def make_loader(num_workers):
+        return DataLoader(train_dataset, **make_batch_sampler(train_dataset, config, shuffle=True), collate_fn=hw_dataset.Collate(),
+                          **worker_kwargs(dict(config, num_workers=num_workers), device, persistent=False))
+    return autotune.tune(config, make_loader, device, batches=config["autotune_batches"],
+                         max_workers=config["autotune_max_workers"])
+
 def check_gpu(config):
     # GPU stuff
     use_gpu = torch.cuda.is_available() and config["GPU"]
@@ -342,6 +484,7 @@ def build_model(config_path):
     config["global_step"] = 0
     config["global_instances_counter"] = 0
     device, dtype = check_gpu(config)
+    set_threads(config)
 
     # Use small batch size when using CPU/testing
     if config["TESTING"]:
@@ -349,7 +492,7 @@ def build_model(config_path):
 
     # Prep data loaders
     LOGGER.info("Loading data...")
-    train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader = load_data(config)
+    train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader = load_data(config, device)
 
     # for x in train_dataloader:
     #     print(x["labels"])
@@ -358,10 +501,28 @@ def build_model(config_path):
     #     print(x['paths'])
     #     Stop
 
+    # Batch augmentation
+    if config["batch_augmentation"]:
+        config["batch_augmenter"] = BatchAugmenter(warp=config["training_warp"],
+                                                   occlusion_freq=config["occlusion_freq"] if config["occlusion"] else None,
+                                                   occlusion_size=config["occlusion_size"],
+                                                   occlusion_level=config["occlusion_level"],
+                                                   noise_level=config["noise_level"],
+                                                   seed=config["augmentation_seed"])
+        config["test_batch_augmenter"] = BatchAugmenter(warp=config["testing_warp"],
+                                                        occlusion_freq=config["occlusion_freq"] if config["testing_occlude"] else None,
+                                                        occlusion_size=config["occlusion_size"],
+                                                        occlusion_level=config["occlusion_level"],
+                                                        seed=config["augmentation_seed"])
+    else:
+        config["batch_augmenter"] = config["test_batch_augmenter"] = None
+
     # Decoder
     config["calc_cer_training"] = calculate_cer
     use_beam = config["decoder_type"] == "beam"
-    config["decoder"] = Decoder(idx_to_char=config["idx_to_char"], beam=use_beam)
+    prefix_beam = ctc_decoder.from_config(config) if config["decoder_type"] == "prefix_beam" else None
+    config["decoder"] = Decoder(idx_to_char=config["idx_to_char"], beam=use_beam, beam_width=config["beam_width"],
+                                beam_processes=config["beam_processes"], prefix_beam=prefix_beam)
 
     # Prep optimizer
     if True:
@@ -418,6 +579,9 @@ def build_model(config_path):
 
     # Stat prep - must be after visdom
     stat_prep(config)
+    config["timer"] = timing.from_config(config)
+    config["profiler"] = profiling.NullProfiler() # main() replaces it while profiling a run
+    config["checkpoint_writer"] = checkpoint.CheckpointWriter(background=config["async_checkpoint"])
 
     # Create optimizer
     if config["optimizer_type"].lower() == "adam":
@@ -457,6 +621,11 @@ def build_model(config_path):
         config["secondary_criterion"] = CrossEntropyLoss()
     else:  # config["style_encoder"] = False
         config["secondary_criterion"] = None
+
+    # Tune on the built model, then rebuild the loaders with the chosen workers/prefetch depth
+    if config["autotune"] and not config["test_only"] and not config["improve_image"]:
+        if tune_workers(config, train_dataset, device) is not None:
+            train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader = make_dataloaders(config, device)
     return config, train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader
 
 def main():
@@ -464,6 +633,11 @@ def main():
     opts = parse_args()
     config, train_dataloader, test_dataloader, train_dataset, test_dataset, validation_dataset, validation_dataloader = build_model(opts.config)
 
+    # Profile the first steps of whichever loop runs (stops itself after the profile_* schedule)
+    mode = "improve" if config["improve_image"] else "test" if config["test_only"] else "train"
+    config["profiler"] = profiling.from_config(config, name=mode)
+    config["profiler"].start()
+
     # Improve
     if config["improve_image"]:
         training_cer = improver(config["model"], test_dataloader, config["criterion"], config["optimizer"],
@@ -514,10 +688,20 @@ def main():
 
         # Final test after everything (test with extra warps/transforms/beam search etc.)
         final_test(config, test_dataloader)
+    config["checkpoint_writer"].close() # wait for the last checkpoint to be on disk
+    config["profiler"].stop()
 
 def final_test(config, test_dataloader):
     ## Do a final test WITH warping and plot all test images
     config["testing_warp"] = True
+    collate_fn = test_dataloader.collate_fn
+    collate_fn.warp = collate_fn.warp or not config["batch_augmentation"] # else test_batch_augmenter warps
+    if getattr(test_dataloader, "persistent_workers", False):
+        # Running workers keep a copy of the old collate settings
+        test_dataloader = prefetch(DataLoader(test_dataloader.dataset, batch_sampler=test_dataloader.batch_sampler, collate_fn=collate_fn,
+                                              **worker_kwargs(config, config["device"], persistent=False)), config, config["device"])
+    if config["test_batch_augmenter"]:
+        config["test_batch_augmenter"].warp = True
     test(config["model"], test_dataloader, config["idx_to_char"], config["device"], config, plot_all=True, validation=False)
     config["stats"][config["designated_test_cer"]].y[-1] *= -1 # shorthand
 
@@ -7,6 +7,7 @@ import torch
 import warnings
 import json
 from crnn import Stat
+import checkpoint
 
 ## Some functions stolen from https://github.com/theevann/visdom-save
 
@@ -84,7 +85,7 @@ class Plot(object):
             print("NOTHING HAS BEEN SAVED: NOTHING IN THIS ENV - DOES IT EXIST ?")
             return
     
-        file = open(file_path, 'w+')
+        lines = []
         for datapoint in data.values():
             output = {
                 'win': datapoint['id'],
@@ -103,8 +104,10 @@ class Plot(object):
                 output['layout'] = datapoint['content']["layout"]
     
             to_write = json.dumps(["events", output])
-            file.write(to_write + '\n')
-        file.close()
+            lines.append(to_write + '\n')
+
+        # Replaced by a rename, so hard links to the previous file (the BSF mirror) keep their contents
+        checkpoint.atomic_write_text("".join(lines), file_path)
 
 def initialize_visdom(env_name, config):
     if not config["use_visdom"]: